@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+
+
+class _Request:
+    def __init__(self, prompt, options, raw):
+        self.prompt = prompt
+        self.options = options
+        self.raw = raw
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchingGenerator:
+    """Front-end that lets many story managers share one GPT2Generator.
+
+    Calls to generate/generate_raw from any thread are queued. A worker thread
+    waits up to max_wait seconds for more requests to arrive, runs everything it
+    collected as one batch and hands each caller back its own result.
+    """
+
+    def __init__(self, generator, max_batch_size=8, max_wait=0.005):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def __getattr__(self, name):
+        # Settings like censor live on the wrapped generator
+        return getattr(self.generator, name)
+
+    def submit(self, prompt, options=None, raw=False):
+        request = _Request(prompt, options, raw)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def generate(self, prompt, options=None, seed=None):
+        return self.submit(prompt, self.generator.seeded(options, seed))
+
+    def generate_raw(self, prompt, options=None):
+        return self.submit(prompt, options, raw=True)
+
+    def collect(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            for raw in (False, True):
+                requests = [request for request in batch if request.raw == raw]
+                if len(requests) == 0:
+                    continue
+                prompts = [request.prompt for request in requests]
+                options = [request.options for request in requests]
+                try:
+                    if raw:
+                        results = self.generator.generate_raw_batch(prompts, options)
+                    else:
+                        results = self.generator.generate_batch(prompts, options)
+                except Exception as e:
+                    for request in requests:
+                        request.error = e
+                        request.done.set()
+                    continue
+                for request, result in zip(requests, results):
+                    request.result = result
+                    request.done.set()
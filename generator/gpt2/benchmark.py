@@ -0,0 +1,223 @@
+"""Micro-benchmark of sampling on a small model with random weights.
+
+No checkpoint is needed, so the numbers can be compared between machines and
+commits. For every batch size and context length it reports the prefill latency
+(running the context and sampling one token), the latency per decoded token and
+the resulting tokens/sec, as p50/p99 over the repeats:
+
+    python -m generator.gpt2.benchmark --backend numpy
+    python -m generator.gpt2.benchmark --backend tensorflow --batch-sizes 1 4 --json out.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from generator.gpt2.src import np_model
+
+
+def random_weights(hparams, seed=0):
+    """Weights named like the checkpoint's, drawn like model.py initializes them."""
+    rng = np.random.RandomState(seed)
+    n_embd = hparams.n_embd
+
+    def normal(shape, stddev=0.02):
+        return (rng.randn(*shape) * stddev).astype(np.float32)
+
+    weights = {
+        "model/wte": normal([hparams.n_vocab, n_embd]),
+        "model/wpe": normal([hparams.n_ctx, n_embd], stddev=0.01),
+        "model/ln_f/g": np.ones([n_embd], dtype=np.float32),
+        "model/ln_f/b": np.zeros([n_embd], dtype=np.float32),
+    }
+    convs = {
+        "attn/c_attn": (n_embd, 3 * n_embd),
+        "attn/c_proj": (n_embd, n_embd),
+        "mlp/c_fc": (n_embd, 4 * n_embd),
+        "mlp/c_proj": (4 * n_embd, n_embd),
+    }
+    for layer in range(hparams.n_layer):
+        scope = "model/h%d/" % layer
+        for norm in ["ln_1", "ln_2"]:
+            weights[scope + norm + "/g"] = np.ones([n_embd], dtype=np.float32)
+            weights[scope + norm + "/b"] = np.zeros([n_embd], dtype=np.float32)
+        for name, (nx, nf) in convs.items():
+            weights[scope + name + "/w"] = normal([1, nx, nf])
+            weights[scope + name + "/b"] = np.zeros([nf], dtype=np.float32)
+    return weights
+
+
+class NumpyRunner:
+    def __init__(self, hparams, quantize=False, seed=0):
+        from generator.gpt2.src import np_sample, weights
+
+        self.hparams = hparams
+        self.weights = random_weights(hparams, seed)
+        if quantize:
+            self.weights = weights.quantize_weights(self.weights)
+        self.np_sample = np_sample
+        self.rng = np.random.RandomState(seed)
+
+    def sample(self, context, length):
+        self.np_sample.sample_sequence(
+            hparams=self.hparams,
+            weights=self.weights,
+            length=length,
+            context=context,
+            temperature=1.0,
+            top_k=40,
+            top_p=0.9,
+            rng=self.rng,
+        )
+
+
+class TFRunner:
+    def __init__(self, hparams, seed=0):
+        import tensorflow as tf
+        from generator.gpt2.src import sample
+
+        tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.set_random_seed(seed)
+            self.context = tf.placeholder(tf.int32, [None, None])
+            self.length = tf.placeholder(tf.int32, [])
+            self.output = sample.sample_sequence(
+                hparams=hparams,
+                length=self.length,
+                context=self.context,
+                temperature=1.0,
+                top_k=40,
+                top_p=0.9,
+            )
+            self.sess = tf.compat.v1.Session(graph=graph)
+            # The same weights as NumpyRunner's
+            weights = random_weights(hparams, seed)
+            for variable in tf.global_variables():
+                variable.load(weights[variable.op.name], self.sess)
+
+    def sample(self, context, length):
+        self.sess.run(self.output, {self.context: context, self.length: length})
+
+
+def measure(runner, context, length, repeats):
+    """Seconds taken by each of repeats calls sampling length tokens after context."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        runner.sample(context, length)
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def run(runner, hparams, batch_sizes, context_lengths, generate_num, repeats, seed=0):
+    """One result dict per (batch size, context length), times in milliseconds."""
+    rng = np.random.RandomState(seed)
+    results = []
+    for batch_size in batch_sizes:
+        for context_length in context_lengths:
+            context = rng.randint(
+                hparams.n_vocab, size=[batch_size, context_length]
+            ).astype(np.int32)
+            # Warm up, so graph construction or caches don't count
+            runner.sample(context, generate_num)
+
+            prefill = measure(runner, context, 1, repeats)
+            total = measure(runner, context, generate_num, repeats)
+            decode = (total - np.median(prefill)) / (generate_num - 1)
+            results.append(
+                {
+                    "batch_size": batch_size,
+                    "context_length": context_length,
+                    "generate_num": generate_num,
+                    "prefill_p50_ms": 1000 * np.percentile(prefill, 50),
+                    "prefill_p99_ms": 1000 * np.percentile(prefill, 99),
+                    "token_p50_ms": 1000 * np.percentile(decode, 50),
+                    "token_p99_ms": 1000 * np.percentile(decode, 99),
+                    "tokens_per_sec": batch_size * generate_num / np.median(total),
+                }
+            )
+    return results
+
+
+COLUMNS = [
+    ("batch_size", "batch", "%5d"),
+    ("context_length", "context", "%7d"),
+    ("prefill_p50_ms", "prefill p50", "%11.2f"),
+    ("prefill_p99_ms", "prefill p99", "%11.2f"),
+    ("token_p50_ms", "token p50", "%9.2f"),
+    ("token_p99_ms", "token p99", "%9.2f"),
+    ("tokens_per_sec", "tokens/sec", "%10.1f"),
+]
+
+
+def print_results(results):
+    print("  ".join(title for _, title, _ in COLUMNS))
+    for result in results:
+        print("  ".join(form % result[name] for name, _, form in COLUMNS))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "python -m generator.gpt2.benchmark", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--backend", choices=["numpy", "int8", "tensorflow"], default="numpy"
+    )
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--context-lengths", type=int, nargs="+", default=[32, 256])
+    parser.add_argument(
+        "--generate-num",
+        type=int,
+        default=32,
+        help="Tokens to sample, at least 2 so there are decode steps to time.",
+    )
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--n-vocab", type=int, default=50257)
+    parser.add_argument("--n-embd", type=int, default=128)
+    parser.add_argument("--n-head", type=int, default=4)
+    parser.add_argument("--n-layer", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+    if args.generate_num < 2:
+        parser.error("--generate-num must be at least 2")
+
+    n_ctx = max(args.context_lengths) + args.generate_num
+    hparams = np_model.default_hparams().override_from_dict(
+        dict(
+            n_vocab=args.n_vocab,
+            n_ctx=n_ctx,
+            n_embd=args.n_embd,
+            n_head=args.n_head,
+            n_layer=args.n_layer,
+        )
+    )
+    if args.backend == "tensorflow":
+        runner = TFRunner(hparams, seed=args.seed)
+    else:
+        runner = NumpyRunner(hparams, quantize=args.backend == "int8", seed=args.seed)
+
+    results = run(
+        runner,
+        hparams,
+        args.batch_sizes,
+        args.context_lengths,
+        args.generate_num,
+        args.repeats,
+        seed=args.seed,
+    )
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"backend": args.backend, "hparams": vars(hparams), "results": results},
+                f,
+                indent=1,
+            )
+
+
+if __name__ == "__main__":
+    main()
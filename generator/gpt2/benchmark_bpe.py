@@ -0,0 +1,111 @@
+"""Compares Encoder.bpe with the original merge loop it replaced.
+
+Both are run on the words of the given files plus long unbroken tokens like those
+found in scraped data, with caching off. Outputs are checked to be identical:
+
+    python -m generator.gpt2.benchmark_bpe generator/gpt2/models/model_v5 story/story_data.yaml
+"""
+
+import argparse
+import os
+import time
+
+from generator.gpt2.src import encoder
+
+
+def reference_bpe(bpe_ranks, token):
+    """The original Encoder.bpe, rescanning every pair after each merge."""
+    word = tuple(token)
+    pairs = encoder.get_pairs(word)
+
+    if not pairs:
+        return token
+
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float("inf")))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        new_word = tuple(new_word)
+        word = new_word
+        if len(word) == 1:
+            break
+        else:
+            pairs = encoder.get_pairs(word)
+    return " ".join(word)
+
+
+def long_tokens(enc):
+    """Tokens the regex doesn't split, as they'd come out of pretokenize."""
+    texts = [
+        "https://www.reddit.com/r/AIDungeon/comments/abcdefghij/the_story_so_far",
+        "!" * 200,
+        "-" * 500,
+        "." * 1000,
+        "hahahahahahahahahahahahahahahahahahahahahahahahahahahahahahahahaha" * 4,
+        "Aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaah" * 4,
+    ]
+    return [token for text in texts for token in enc.pretokenize(text)]
+
+
+def measure(function, tokens, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for token in tokens:
+            function(token)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "python -m generator.gpt2.benchmark_bpe", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "model_path", help="The model directory, e.g. generator/gpt2/models/model_v5"
+    )
+    parser.add_argument("corpus", nargs="*", help="Text files to take words from.")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model_dir, model_name = os.path.split(os.path.normpath(args.model_path))
+    enc = encoder.get_encoder(model_name, model_dir, cache_size=0)
+
+    words = set()
+    for path in args.corpus:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            words.update(enc.pretokenize(f.read()))
+
+    for name, tokens in [("corpus words", sorted(words)), ("long tokens", long_tokens(enc))]:
+        if len(tokens) == 0:
+            continue
+        for token in tokens:
+            assert enc.bpe(token) == reference_bpe(enc.bpe_ranks, token), token
+        old = measure(lambda token: reference_bpe(enc.bpe_ranks, token), tokens, args.repeats)
+        new = measure(enc.bpe, tokens, args.repeats)
+        print(
+            "%-12s  %6d tokens  original %8.1f ms  heap %8.1f ms  %5.1fx"
+            % (name, len(tokens), 1000 * old, 1000 * new, old / new)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import argparse
+import os
+from collections import Counter
+
+from generator.gpt2.src import encoder
+
+parser = argparse.ArgumentParser(
+    "python -m generator.gpt2.build_bpe_cache",
+    description="Pre-compute the byte pair merges of the most common words of a corpus, "
+    "which get_encoder then loads into the encoder's cache on startup.",
+)
+parser.add_argument(
+    "model_path", help="The model directory, e.g. generator/gpt2/models/model_v5"
+)
+parser.add_argument("corpus", nargs="+", help="Text files to count words in.")
+parser.add_argument("--size", type=int, default=2 ** 16, help="Number of words kept.")
+args = parser.parse_args()
+
+model_dir, model_name = os.path.split(os.path.normpath(args.model_path))
+enc = encoder.get_encoder(model_name, model_dir, cache_size=args.size)
+enc.cache = encoder.BPECache(max_entries=args.size)
+
+counts = Counter()
+for path in args.corpus:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        counts.update(enc.pretokenize(f.read()))
+
+# Most common last, so they are the most recently used and saved first
+for token, _ in reversed(counts.most_common(args.size)):
+    enc.bpe(token)
+
+cache_path = os.path.join(args.model_path, encoder.BPE_CACHE_FILE)
+enc.cache.save(cache_path)
+print("Saved " + str(len(enc.cache)) + " words to " + cache_path)
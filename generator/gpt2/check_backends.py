@@ -0,0 +1,133 @@
+"""Checks that the TensorFlow and NumPy backends sample the same tokens.
+
+Both run sample_sequence on benchmark.random_weights, seeded and with top_k=1, so
+every sample is the most likely token and must be the same for both. The keys
+and values they return must agree to within --tolerance. Rows of the batch have
+different lengths, so left padding is checked too:
+
+    python -m generator.gpt2.check_backends
+    python -m generator.gpt2.check_backends --n-layer 12 --n-embd 768 --n-head 12
+"""
+
+import argparse
+
+import numpy as np
+
+from generator.gpt2.benchmark import random_weights
+from generator.gpt2.src import np_model, np_sample
+
+
+def numpy_sample(hparams, weights, context, mask, length, seed):
+    return np_sample.sample_sequence(
+        hparams=hparams,
+        weights=weights,
+        length=length,
+        context=context,
+        mask=mask,
+        top_k=1,
+        seed=list(seed),
+    )
+
+
+def tf_sample(hparams, weights, context, mask, length, seed):
+    import tensorflow as tf
+    from generator.gpt2.src import sample
+
+    graph = tf.Graph()
+    with graph.as_default():
+        # Fed like TFSampler feeds them
+        feeds = {
+            "context": tf.placeholder(tf.int32, [None, None]),
+            "mask": tf.placeholder(tf.int32, [None, None]),
+            "length": tf.placeholder(tf.int32, []),
+            "seed": tf.placeholder(tf.int32, [None]),
+        }
+        output, presents = sample.sample_sequence(
+            hparams=hparams,
+            length=feeds["length"],
+            context=feeds["context"],
+            mask=feeds["mask"],
+            top_k=1,
+            seed=feeds["seed"],
+            return_presents=True,
+        )
+        values = {"context": context, "mask": mask, "length": length, "seed": seed}
+        with tf.compat.v1.Session(graph=graph) as sess:
+            for variable in tf.global_variables():
+                variable.load(weights[variable.op.name], sess)
+            return sess.run(
+                [output, presents],
+                {feeds[name]: value for name, value in values.items()},
+            )
+
+
+def padded_batch(rng, n_vocab, lengths):
+    """Random contexts of the given lengths, left padded, and their mask."""
+    width = max(lengths)
+    context = np.zeros([len(lengths), width], dtype=np.int32)
+    mask = np.zeros([len(lengths), width], dtype=np.int32)
+    for row, length in enumerate(lengths):
+        context[row, width - length :] = rng.randint(n_vocab, size=length)
+        mask[row, width - length :] = 1
+    return context, mask
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "python -m generator.gpt2.check_backends", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--context-lengths", type=int, nargs="+", default=[5, 32, 64])
+    parser.add_argument("--generate-num", type=int, default=16)
+    parser.add_argument("--n-vocab", type=int, default=50257)
+    parser.add_argument("--n-embd", type=int, default=128)
+    parser.add_argument("--n-head", type=int, default=4)
+    parser.add_argument("--n-layer", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    hparams = np_model.default_hparams().override_from_dict(
+        dict(
+            n_vocab=args.n_vocab,
+            n_ctx=max(args.context_lengths) + args.generate_num,
+            n_embd=args.n_embd,
+            n_head=args.n_head,
+            n_layer=args.n_layer,
+        )
+    )
+    weights = random_weights(hparams, args.seed)
+    rng = np.random.RandomState(args.seed)
+    context, mask = padded_batch(rng, args.n_vocab, args.context_lengths)
+    seed = np.arange(len(args.context_lengths), dtype=np.int32) + args.seed
+
+    results = {}
+    for name, sample in [("numpy", numpy_sample), ("tensorflow", tf_sample)]:
+        results[name] = sample(hparams, weights, context, mask, args.generate_num, seed)
+    (np_tokens, np_presents), (tf_tokens, tf_presents) = results.values()
+
+    failures = 0
+    width = context.shape[1]
+    for row in range(len(context)):
+        if not np.array_equal(np_tokens[row, width:], tf_tokens[row, width:]):
+            failures += 1
+            print(
+                "row %d: numpy sampled %s, tensorflow %s"
+                % (row, list(np_tokens[row, width:]), list(tf_tokens[row, width:]))
+            )
+    # Padding columns hold whatever each backend computed for them
+    valid = np.concatenate(
+        [mask, np.ones([len(context), np_presents.shape[-2] - width], dtype=mask.dtype)],
+        axis=1,
+    ).astype(bool)
+    difference = np.abs(np_presents - tf_presents).max(axis=(1, 2, 3, 5))
+    difference = difference[valid].max()
+    print("largest difference of the keys and values: %g" % difference)
+    if difference > args.tolerance:
+        failures += 1
+    print("%d mismatches" % failures)
+    if failures > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Checks that a seed gives the same text however the generation is requested.
+
+For every seed, generate, the joined chunks of generate_stream and generate_batch
+(with the prompt between others) must return the same text. The result cache is
+off, so every one of them samples:
+
+    python -m generator.gpt2.check_seeded --numpy
+    python -m generator.gpt2.check_seeded --numpy --draft 124M
+"""
+
+import argparse
+
+from generator.gpt2.gpt2_generator import GPT2Generator
+
+PROMPTS = [
+    "You are a knight in the kingdom of Larion. You are hunting the evil dragon who "
+    "has been terrorizing the kingdom. You enter the forest searching for the dragon and see",
+    "You are a scavenger living in an abandoned city. You have a small pistol and a "
+    "backpack. You open the door of the old store and",
+]
+
+
+def check(generator, prompt, seed):
+    """The texts that differ from generate's, by how they were requested."""
+    expected = generator.generate(prompt, seed=seed)
+    texts = {
+        "generate_stream": "".join(generator.generate_stream(prompt, seed=seed)),
+        "generate_batch": generator.generate_batch(
+            ["You walk into the tavern.", prompt, "You say hello."],
+            [None, {"seed": seed}, {"seed": seed + 1}],
+        )[1],
+    }
+    return expected, {name: text for name, text in texts.items() if text != expected}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "python -m generator.gpt2.check_seeded", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--cpu", action="store_true")
+    parser.add_argument("--numpy", action="store_true")
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--draft", metavar="MODEL")
+    parser.add_argument("--seeds", type=int, default=4, help="Number of seeds to try.")
+    args = parser.parse_args()
+
+    backend = "numpy" if args.numpy or args.int8 or args.draft else "tensorflow"
+    generator = GPT2Generator(
+        force_cpu=args.cpu,
+        backend=backend,
+        quantize=args.int8,
+        draft_model=args.draft,
+        cached_results=0,
+    )
+    failures = 0
+    for prompt in PROMPTS:
+        for seed in range(args.seeds):
+            expected, differing = check(generator, prompt, seed)
+            for name, text in differing.items():
+                failures += 1
+                print("seed %d: %s gave %r, generate %r" % (seed, name, text, expected))
+    print("%d mismatches" % failures)
+    if failures > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import argparse
+
+import tensorflow as tf
+from generator.gpt2.src import weights
+
+parser = argparse.ArgumentParser(
+    "python -m generator.gpt2.convert_weights",
+    description="Convert a checkpoint into the memory-mapped weights GPT2Generator loads.",
+)
+parser.add_argument(
+    "model_path", help="The model directory, e.g. generator/gpt2/models/model_v5"
+)
+parser.add_argument(
+    "--int8",
+    action="store_true",
+    help="Also write int8 weights, which the NumPy backend maps with --int8 instead of "
+    "quantizing in every process.",
+)
+args = parser.parse_args()
+model_path = args.model_path
+
+reader = tf.train.load_checkpoint(tf.train.latest_checkpoint(model_path))
+# Optimizer slots are only needed for training
+names = sorted(
+    name
+    for name in reader.get_variable_to_shape_map()
+    if name.startswith("model/") and "Adam" not in name
+)
+
+print("Converting " + str(len(names)) + " variables in " + model_path)
+weights.save_weights(((name, reader.get_tensor(name)) for name in names), model_path)
+if args.int8:
+    print("Writing int8 weights")
+    weights.save_weights(
+        weights.quantize_items((name, reader.get_tensor(name)) for name in names),
+        model_path,
+        quantized=True,
+    )
+print("Done. GPT2Generator will now map the weights instead of restoring them.")
@@ -1,20 +1,51 @@
 import json
 import os
+import threading
+import time
 import warnings
+from functools import wraps
 
 import numpy as np
 
-import tensorflow as tf
-from generator.gpt2.src import encoder, model, sample
+from generator.gpt2.past_cache import PastCache, PrefixCache
+from generator.gpt2.result_cache import ResultCache
+from generator.gpt2.src import encoder, np_model
+from story import timing
 from story.utils import *
 
 warnings.filterwarnings("ignore")
 
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+def locked(method):
+    """Run method holding the generator's lock, noting when and by which thread it
+    was last used.
+
+    While waiting for the lock the call counts in self.waiting, so background work
+    can see that someone wants the generator and let go of it.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.waiting_lock:
+            self.waiting += 1
+        try:
+            self.lock.acquire()
+        finally:
+            with self.waiting_lock:
+                self.waiting -= 1
+        try:
+            self.last_used = time.time()
+            self.last_user = threading.get_ident()
+            return method(self, *args, **kwargs)
+        finally:
+            self.last_used = time.time()
+            self.lock.release()
+
+    return wrapper
 
 
 class GPT2Generator:
-    def __init__(self, generate_num=60, temperature=0.4, top_k=40, top_p=0.9, censor=True, force_cpu=False):
+    def __init__(self, generate_num=60, temperature=0.4, top_k=40, top_p=0.9, censor=True, force_cpu=False, cached_sessions=1, max_batch_size=8, stream_chunk=4, stop_strings=("<", ">"), max_sentences=0, backend="tensorflow", quantize=False, draft_model=None, draft_length=4, cached_results=1024, result_cache_path=None, shared_prefix_bytes=2 ** 30):
         self.generate_num = generate_num
         self.temp = temperature
         self.top_k = top_k
@@ -26,43 +57,146 @@ class GPT2Generator:
         self.checkpoint_path = os.path.join(self.model_dir, self.model_name)
 
         models_dir = os.path.expanduser(os.path.expandvars(self.model_dir))
-        self.batch_size = 1
-        self.samples = 1
+        self.max_batch_size = max_batch_size
 
         self.enc = encoder.get_encoder(self.model_name, models_dir)
-        hparams = model.default_hparams()
-        with open(os.path.join(models_dir, self.model_name, "hparams.json")) as f:
-            hparams.override_from_dict(json.load(f))
+        hparams = self.load_hparams(models_dir, self.model_name)
+        self.hparams = hparams
         seed = np.random.randint(0, 100000)
 
-        config = None
-        if force_cpu:
-            config = tf.compat.v1.ConfigProto(
-                device_count={"GPU": 0}
+        # result_replace cuts everything after "<" and ">", so sampling stops there.
+        # Optionally it also stops after max_sentences sentences.
+        self.stop_tokens = self.enc.tokens_containing(stop_strings)
+        self.sentence_tokens = self.enc.tokens_containing([".", "!", "?"])
+        self.max_sentences = max_sentences
+        self.end_token = self.enc.encoder["<|endoftext|>"]
+
+        self.stream_chunk = stream_chunk
+
+        # The model and caches are used by one thread at a time. Background work
+        # like the opening pool can check waiting, last_used and last_user to run
+        # when nobody else is.
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+        self.last_user = None
+        # Number of calls waiting for lock
+        self.waiting = 0
+        self.waiting_lock = threading.Lock()
+
+        # Keys/values of previous prompts so each turn only runs its new tokens
+        self.past_cache = PastCache(max_entries=cached_sessions)
+        # and of prompt prefixes that many sessions start with
+        self.prefix_cache = PrefixCache(max_bytes=shared_prefix_bytes)
+
+        # Raw results of seeded requests, which always come out the same. Anything
+        # that changes what a seed samples is part of the model id.
+        self.result_cache = ResultCache(
+            max_entries=cached_results, path=result_cache_path
+        )
+        self.model_id = [
+            self.model_name,
+            backend,
+            quantize,
+            draft_model,
+            sorted(stop_strings),
+            max_sentences,
+        ]
+
+        model_path = os.path.join(models_dir, self.model_name)
+        sampling = dict(
+            stop_tokens=self.stop_tokens,
+            sentence_tokens=self.sentence_tokens,
+            max_sentences=self.max_sentences,
+            end_token=self.end_token,
+        )
+        if draft_model is not None:
+            # A smaller model like 124M, laid out like model_name in model_dir
+            if backend != "numpy":
+                raise ValueError("Speculative decoding needs the numpy backend")
+            sampling.update(
+                draft_hparams=self.load_hparams(models_dir, draft_model),
+                draft_path=os.path.join(models_dir, draft_model),
+                draft_length=draft_length,
+            )
+        # Imported here so only the chosen backend has to be installed
+        if backend == "numpy":
+            from generator.gpt2.np_sampler import NumpySampler
+
+            self.sampler = NumpySampler(
+                hparams, model_path, seed=seed, quantize=quantize, **sampling
             )
         else:
-            config = tf.compat.v1.ConfigProto()
-            config.gpu_options.allow_growth = True
-        self.sess = tf.compat.v1.Session(config=config)
-
-        self.context = tf.placeholder(tf.int32, [self.batch_size, None])
-        # np.random.seed(seed)
-        # tf.set_random_seed(seed)
-        self.output = sample.sample_sequence(
-            hparams=hparams,
-            length=self.generate_num,
-            context=self.context,
-            batch_size=self.batch_size,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
+            from generator.gpt2.tf_sampler import TFSampler
 
-        saver = tf.train.Saver()
-        ckpt = tf.train.latest_checkpoint(os.path.join(models_dir, self.model_name))
-        saver.restore(self.sess, ckpt)
+            self.sampler = TFSampler(
+                hparams, model_path, force_cpu=force_cpu, **sampling
+            )
+
+    @staticmethod
+    def load_hparams(models_dir, model_name):
+        # model.default_hparams would need TensorFlow even for the numpy backend
+        hparams = np_model.default_hparams()
+        with open(os.path.join(models_dir, model_name, "hparams.json")) as f:
+            hparams.override_from_dict(json.load(f))
+        return hparams
+
+    def sampling_settings(self, options=None):
+        """Defaults from the constructor, overridden by any given in options."""
+        settings = {
+            "temperature": self.temp,
+            "top_k": self.top_k,
+            "top_p": self.top_p,
+            "generate_num": self.generate_num,
+            "seed": None,
+        }
+        if options is not None:
+            settings.update(options)
+        return settings
+
+    def prompt_budget(self, options=None):
+        """Number of prompt tokens that leave room to generate within n_ctx."""
+        return self.hparams.n_ctx - self.sampling_settings(options)["generate_num"]
+
+    def encode_prompt(self, prompt, options=None):
+        """encode, keeping only as many of the last tokens as prompt_budget allows."""
+        tokens = self.encode(prompt)
+        budget = self.prompt_budget(options)
+        if len(tokens) > budget:
+            tokens = tokens[len(tokens) - budget :]
+        return tokens
+
+    def lookup_past(self, tokens):
+        """past_cache.lookup, or the shared prefix cache's past if that covers more."""
+        cache_key, past, past_length = self.past_cache.lookup(tokens)
+        shared_past, shared_length = self.prefix_cache.lookup(tokens)
+        if shared_length > past_length:
+            return None, shared_past, shared_length
+        return cache_key, past, past_length
+
+    def stopped(self, tokens):
+        """Whether result_replace would throw away anything generated after tokens."""
+        sentences = 0
+        for token in tokens:
+            if token in self.stop_tokens:
+                return True
+            if token in self.sentence_tokens:
+                sentences += 1
+        return self.max_sentences > 0 and sentences >= self.max_sentences
+
+    @locked
+    def encode(self, prompt):
+        """Token ids of prompt, which can also already be a list of token ids."""
+        if not isinstance(prompt, str):
+            return list(prompt)
+        with timing.stage("encode"):
+            return self.enc.encode(prompt)
 
     def prompt_replace(self, prompt):
+        if not isinstance(prompt, str):
+            if len(prompt) > 0 and self.enc.decode(prompt[-1:]) == " ":
+                prompt = prompt[:-1]
+            return prompt
+
         # print("\n\nBEFORE PROMPT_REPLACE:")
         # print(repr(prompt))
         if len(prompt) > 0 and prompt[-1] == " ":
@@ -74,6 +208,7 @@ class GPT2Generator:
         # print(repr(prompt))
         return prompt
 
+    @timing.timed()
     def result_replace(self, result):
         # print("\n\nBEFORE RESULT_REPLACE:")
         # print(repr(result))
@@ -99,31 +234,279 @@ class GPT2Generator:
 
         return result
 
-    def generate_raw(self, prompt):
-        context_tokens = self.enc.encode(prompt)
-        generated = 0
-        for _ in range(self.samples // self.batch_size):
-            out = self.sess.run(
-                self.output,
-                feed_dict={
-                    self.context: [context_tokens for _ in range(self.batch_size)]
-                },
-            )[:, len(context_tokens) :]
-            for i in range(self.batch_size):
-                generated += 1
-                text = self.enc.decode(out[i])
-        return text
-
-    def generate(self, prompt, options=None, seed=1):
+    def share_prefix(self, rows):
+        """rows, with the prompt prefix they all share run once and given to them as past.
+
+        Only rows whose own past covers less of the prefix are changed, and the
+        prefix always leaves a token of every prompt to run.
+        """
+        prefix_length = min(len(tokens) for tokens, *_ in rows) - 1
+        first = rows[0][0]
+        for tokens, *_ in rows[1:]:
+            prefix_length = next(
+                (i for i in range(prefix_length) if tokens[i] != first[i]), prefix_length
+            )
+        if sum(row[3] < prefix_length for row in rows) < 2:
+            return rows
+
+        # Continue from the longest past there is, which may already cover the prefix
+        _, _, past, past_length, settings = max(rows, key=lambda row: row[3])
+        if past_length < prefix_length:
+            prefix_row = (first[:prefix_length], None, past, past_length, settings)
+            with timing.stage("prefill"):
+                _, presents = self.sampler.sample(*self.pad_batch([prefix_row]), 1)
+            timing.count("run_tokens", prefix_length - past_length)
+            past = presents[0]
+        past = past[..., :prefix_length, :]
+        return [
+            (tokens, cache_key, past, prefix_length, settings)
+            if row_length < prefix_length
+            else (tokens, cache_key, row_past, row_length, settings)
+            for tokens, cache_key, row_past, row_length, settings in rows
+        ]
+
+    def pad_batch(self, rows):
+        """Left pad the prompts and cached pasts of rows so they line up in one batch.
+
+        Returns the context, mask, past and per row sampling settings to sample with.
+        """
+        past_width = max(past_length for _, _, _, past_length, _ in rows)
+        new_width = max(len(tokens) - past_length for tokens, _, _, past_length, _ in rows)
+        width = past_width + new_width
+
+        context = np.zeros([len(rows), width], dtype=np.int32)
+        mask = np.zeros([len(rows), width], dtype=np.int32)
+        past = np.zeros(
+            np_model.past_shape(
+                hparams=self.hparams, batch_size=len(rows), sequence=past_width
+            ),
+            dtype=np.float32,
+        )
+        for j, (tokens, _, row_past, past_length, _) in enumerate(rows):
+            new_length = len(tokens) - past_length
+            context[j, past_width - past_length : past_width] = tokens[:past_length]
+            context[j, width - new_length :] = tokens[past_length:]
+            mask[j, past_width - past_length : past_width] = 1
+            mask[j, width - new_length :] = 1
+            if past_length > 0:
+                past[j, ..., past_width - past_length : past_width, :] = row_past
+
+        return context, mask, past, self.batch_settings([row[4] for row in rows])
+
+    @staticmethod
+    def batch_settings(settings):
+        """The settings of every row as lists, as the samplers take them."""
+        return {
+            name: [row_settings[name] for row_settings in settings]
+            for name in ["temperature", "top_k", "top_p", "seed"]
+        }
+
+    @locked
+    @timing.timed("generate", kind=timing.turn)
+    def generate_raw_batch(self, prompts, options=None):
+        """options is an optional list with a dict of sampling settings per prompt.
+
+        Prompts are strings or lists of token ids.
+
+        A prompt with a "seed" setting always gives the same text, which is then
+        served from the result cache. With "cache_past": False its keys/values
+        aren't kept in the past cache, so background work doesn't push out those
+        of the players.
+        """
+        if options is None:
+            options = [None] * len(prompts)
+
+        texts = [None] * len(prompts)
+        rows = {}
+        result_keys = {}
+        used_keys = set()
+        for i, (prompt, prompt_options) in enumerate(zip(prompts, options)):
+            context_tokens = self.encode_prompt(prompt, prompt_options)
+            timing.count("prompt_tokens", len(context_tokens))
+            settings = self.sampling_settings(prompt_options)
+            if settings["seed"] is not None:
+                result_keys[i] = self.result_cache.key(
+                    self.model_id, context_tokens, settings
+                )
+                texts[i] = self.result_cache.get(result_keys[i])
+                if texts[i] is not None:
+                    continue
+
+            cache_key, past, past_length = self.lookup_past(context_tokens)
+            # Two rows continuing the same cached prompt must not overwrite each other
+            if cache_key in used_keys:
+                cache_key = None
+            used_keys.add(cache_key)
+            rows[i] = (context_tokens, cache_key, past, past_length, settings)
+
+        # A batch samples the same number of tokens for every row, and a prompt only
+        # leaves room for its own generate_num, so rows are batched with others
+        # asking for as many. Among those, prompts of similar length go together
+        # to keep padding down.
+        order = sorted(rows, key=lambda i: (rows[i][4]["generate_num"], len(rows[i][0])))
+        batches = []
+        for i in order:
+            if (
+                len(batches) > 0
+                and len(batches[-1]) < self.max_batch_size
+                and rows[batches[-1][0]][4]["generate_num"] == rows[i][4]["generate_num"]
+            ):
+                batches[-1].append(i)
+            else:
+                batches.append([i])
+
+        for batch in batches:
+            # Prompts continuing the same story only run the story once
+            rows.update(zip(batch, self.share_prefix([rows[i] for i in batch])))
+            length = rows[batch[0]][4]["generate_num"]
+            context, mask, past, settings = self.pad_batch([rows[i] for i in batch])
+            with timing.stage("sample"):
+                out, presents = self.sampler.sample(context, mask, past, settings, length)
+            timing.count("run_tokens", int(mask.sum()) - sum(rows[i][3] for i in batch))
+            timing.count("sampled_tokens", len(batch) * (out.shape[1] - mask.shape[1]))
+
+            width = mask.shape[1]
+            generated = np.ones([len(batch), out.shape[1] - width], dtype=mask.dtype)
+            valid = np.concatenate([mask, generated], axis=1).astype(bool)
+            for j, i in enumerate(batch):
+                # presents covers every token but the last sampled one
+                tokens = out[j][valid[j]]
+                row_presents = presents[j][..., valid[j, :-1], :]
+                if rows[i][4].get("cache_past", True):
+                    self.past_cache.store(rows[i][1], tokens[:-1], row_presents)
+                self.prefix_cache.store(rows[i][0], row_presents)
+                generate_num = rows[i][4]["generate_num"]
+                sampled = list(out[j, width : width + generate_num])
+                # Rows that finished before the rest of the batch are filled with end_token
+                if self.end_token in sampled:
+                    sampled = sampled[: sampled.index(self.end_token)]
+                with timing.stage("decode"):
+                    texts[i] = self.enc.decode(sampled)
+                if i in result_keys:
+                    self.result_cache.put(result_keys[i], texts[i])
+        return texts
+
+    def generate_raw(self, prompt, options=None):
+        return self.generate_raw_batch([prompt], [options])[0]
+
+    def seeded(self, options, seed):
+        """options with seed added, unless seed is None or options already has one."""
+        if seed is None:
+            return options
+        return dict({"seed": seed}, **(options or {}))
+
+    def generate_batch(self, prompts, options=None, seed=None):
+        if options is None:
+            options = [None] * len(prompts)
+        options = [self.seeded(prompt_options, seed) for prompt_options in options]
+        prompts = [self.prompt_replace(prompt) for prompt in prompts]
+        results = [""] * len(prompts)
+        pending = list(range(len(prompts)))
+        while pending:
+            texts = self.generate_raw_batch(
+                [prompts[i] for i in pending], [options[i] for i in pending]
+            )
+            for i, text in zip(pending, texts):
+                results[i] = self.result_replace(text)
+            pending = [i for i in pending if len(results[i]) == 0]
+            for i in pending:
+                # A seeded retry would sample the same empty result again
+                if options[i] is not None and options[i].get("seed") is not None:
+                    options[i] = dict(options[i], seed=options[i]["seed"] + 1)
+        return results
+
+    @locked
+    def sample_chunk(self, tokens, settings, length, kept=None):
+        """Sample length tokens after tokens, returning them all and what to keep for
+        the next chunk.
+
+        kept is what the previous chunk returned, its presents still in the sampler
+        (see keep_past) so they aren't copied out and back in for every chunk. The
+        first chunk of a prompt looks up its past in the caches instead.
+        """
+        if kept is None:
+            cache_key, past, past_length = self.lookup_past(tokens)
+            row = (tokens, cache_key, past, past_length, settings)
+            context, mask, past, row_settings = self.pad_batch([row])
+        else:
+            # The previous chunk's presents cover all but its last sampled token
+            cache_key, past = kept
+            past_length = len(tokens) - 1
+            context = np.array([tokens], dtype=np.int32)
+            mask = np.ones_like(context)
+            row_settings = self.batch_settings([settings])
+        with timing.stage("sample"):
+            out, presents = self.sampler.sample(
+                context, mask, past, row_settings, length, keep_past=True
+            )
+        timing.count("run_tokens", len(tokens) - past_length)
+        timing.count("sampled_tokens", out.shape[1] - len(tokens))
+        return out, (cache_key, presents)
+
+    @locked
+    def store_kept(self, context_tokens, tokens, settings, kept):
+        """Put the presents a stream ended with in the caches, as generate_raw_batch
+        does with its own."""
+        cache_key, presents = kept
+        presents = self.sampler.fetch_past(presents)[0]
+        if settings.get("cache_past", True):
+            self.past_cache.store(cache_key, tokens[:-1], presents)
+        self.prefix_cache.store(context_tokens, presents)
+
+    def generate_stream(self, prompt, options=None, seed=None):
+        """Like generate, but yields the result in pieces as tokens are sampled.
+
+        A chunk of tokens that adds no text yields "", so the caller can pause or
+        stop between any two chunks.
+        """
+        options = self.seeded(options, seed)
+        settings = self.sampling_settings(options)
+        generate_num = settings["generate_num"]
+        prompt = self.prompt_replace(prompt)
+        context_tokens = self.encode_prompt(prompt, options)
+        timing.count("prompt_tokens", len(context_tokens))
+        tokens = context_tokens
+        kept = None
+        shown = ""
+        while len(tokens) - len(context_tokens) < generate_num:
+            # The last chunk may be shorter, so the prompt budget isn't overrun
+            length = min(self.stream_chunk, len(context_tokens) + generate_num - len(tokens))
+            out, kept = self.sample_chunk(tokens, settings, length, kept)
+            tokens = list(out[0])
+            generated = tokens[len(context_tokens) :]
+
+            with timing.stage("decode"):
+                text = self.enc.decode(generated)
+            result = self.result_replace(text)
+            if len(generated) < generate_num and not self.stopped(generated):
+                # A character split between tokens decodes as U+FFFD until its last byte arrives
+                result = result.rstrip("\ufffd")
+            # Text is only shown once post-processing can't take it back
+            if result.startswith(shown) and len(result) > len(shown):
+                yield result[len(shown) :]
+                shown = result
+            else:
+                yield ""
+            if self.stopped(generated):
+                break
+        self.store_kept(context_tokens, tokens, settings, kept)
+
+        if len(shown) == 0:
+            if settings["seed"] is not None:
+                options = dict(options, seed=settings["seed"] + 1)
+            yield from self.generate_stream(prompt, options)
+
+    def generate(self, prompt, options=None, seed=None):
 
         debug_print = False
+        options = self.seeded(options, seed)
         prompt = self.prompt_replace(prompt)
 
         if debug_print:
             print("******DEBUG******")
             print("Prompt is: ", repr(prompt))
 
-        text = self.generate_raw(prompt)
+        text = self.generate_raw(prompt, options)
 
         if debug_print:
             print("Generated result is: ", repr(text))
@@ -132,6 +515,8 @@ class GPT2Generator:
         result = text
         result = self.result_replace(result)
         if len(result) == 0:
-            return self.generate(prompt)
+            if options is not None and options.get("seed") is not None:
+                options = dict(options, seed=options["seed"] + 1)
+            return self.generate(prompt, options)
 
         return result
@@ -0,0 +1,95 @@
+import numpy as np
+
+from generator.gpt2.src import np_sample, weights
+
+
+class NumpySampler:
+    """Runs np_sample.sample_sequence on weights mapped straight from disk.
+
+    With a draft model, a smaller GPT-2 sharing the encoder, sampling switches to
+    np_sample.speculative_sample_sequence.
+    """
+
+    def __init__(
+        self,
+        hparams,
+        model_path,
+        *,
+        stop_tokens,
+        sentence_tokens,
+        max_sentences,
+        end_token,
+        seed=None,
+        quantize=False,
+        draft_hparams=None,
+        draft_path=None,
+        draft_length=4
+    ):
+        self.hparams = hparams
+        self.weights = self.load(model_path, quantize)
+        self.draft_hparams = draft_hparams
+        self.draft_length = draft_length
+        if draft_path is not None:
+            if draft_hparams.n_vocab != hparams.n_vocab:
+                raise ValueError("The draft model must use the same encoder")
+            self.draft_weights = self.load(draft_path, quantize)
+        self.stop_tokens = stop_tokens
+        self.sentence_tokens = sentence_tokens
+        self.max_sentences = max_sentences
+        self.end_token = end_token
+        self.rng = np.random.RandomState(seed)
+
+    @staticmethod
+    def load(model_path, quantize):
+        if quantize and weights.has_weights(model_path, quantized=True):
+            # Mapped like the float weights, so shared with other processes
+            return weights.load_weights(model_path, quantized=True)
+        if not weights.has_weights(model_path):
+            raise FileNotFoundError(
+                "The numpy backend needs converted weights, run "
+                "python -m generator.gpt2.convert_weights " + model_path
+            )
+        loaded = weights.load_weights(model_path)
+        if quantize:
+            # The mapped float pages are only read once and can then be dropped,
+            # but the int8 copy is private to this process
+            loaded = weights.quantize_weights(loaded)
+        return loaded
+
+    def sample(self, context, mask, past, settings, length, keep_past=False):
+        """Returns the context followed by the samples, and the presents of both.
+
+        The presents are arrays either way, keep_past is for TFSampler's sake.
+        """
+        if self.draft_hparams is None:
+            sample_sequence = np_sample.sample_sequence
+            draft = {}
+        else:
+            sample_sequence = np_sample.speculative_sample_sequence
+            draft = dict(
+                draft_hparams=self.draft_hparams,
+                draft_weights=self.draft_weights,
+                draft_length=self.draft_length,
+            )
+        return sample_sequence(
+            hparams=self.hparams,
+            weights=self.weights,
+            length=length,
+            context=context,
+            past=past,
+            mask=mask,
+            temperature=settings["temperature"],
+            top_k=settings["top_k"],
+            top_p=settings["top_p"],
+            stop_tokens=self.stop_tokens,
+            sentence_tokens=self.sentence_tokens,
+            max_sentences=self.max_sentences,
+            end_token=self.end_token,
+            seed=settings["seed"],
+            rng=self.rng,
+            **draft
+        )
+
+    @staticmethod
+    def fetch_past(past):
+        return past
@@ -0,0 +1,139 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+def common_prefix_length(a, b):
+    """Number of leading tokens a and b have in common."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PastCache:
+    """Keeps the attention keys/values of recent prompts around between turns.
+
+    Each turn's prompt is usually the previous prompt plus one action/result pair,
+    so the longest cached prefix of the new prompt lets the model skip straight to
+    the tokens that were added. Entries are evicted least recently used first.
+    """
+
+    def __init__(self, max_entries=1):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.next_key = 0
+
+    def lookup(self, tokens):
+        """Find the cached past sharing the longest prefix with tokens.
+
+        Returns (key, past, length) where past covers tokens[:length]. At least one
+        token is always left uncovered so the model has something to run. key is
+        None if nothing matched.
+        """
+        best_key, best_length = None, 0
+        for key, (cached_tokens, _) in self.entries.items():
+            length = common_prefix_length(cached_tokens, tokens)
+            if length > best_length:
+                best_key, best_length = key, length
+
+        if best_key is None:
+            return None, None, 0
+
+        self.entries.move_to_end(best_key)
+        length = min(best_length, len(tokens) - 1)
+        past = self.entries[best_key][1][..., :length, :]
+        return best_key, past, length
+
+    def store(self, key, tokens, past):
+        """Remember past for tokens, replacing the entry key was looked up from."""
+        if self.max_entries <= 0:
+            return
+        if key is None:
+            key = self.next_key
+            self.next_key += 1
+        self.entries[key] = (list(tokens), past)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class PrefixCache:
+    """Keys/values of prompt prefixes shared by many sessions, like curated openings.
+
+    Prefixes are cut at multiples of block_size tokens and looked up by a hash of
+    their tokens, so a new prompt finds the longest cached prefix with one lookup
+    per block. A prefix is only stored the second time it is seen, so one-off
+    prompts don't push out popular ones. Entries are evicted least recently used
+    first once together they take more than max_bytes.
+    """
+
+    def __init__(self, max_bytes=2 ** 30, block_size=32, max_seen=2 ** 15):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.max_seen = max_seen
+        self.entries = OrderedDict()
+        self.seen = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def prefix_keys(self, tokens, limit):
+        """(length, key) for each multiple of block_size up to limit, where key
+        is a hash of tokens[:length]."""
+        keys = []
+        key = None
+        for length in range(self.block_size, limit + 1, self.block_size):
+            key = hash((key, tuple(tokens[length - self.block_size : length])))
+            keys.append((length, key))
+        return keys
+
+    def lookup(self, tokens):
+        """Returns (past, length) for the longest cached prefix of tokens, leaving at
+        least one token uncovered, or (None, 0)."""
+        for length, key in reversed(self.prefix_keys(tokens, len(tokens) - 1)):
+            entry = self.entries.get(key)
+            # Guard against hash collisions
+            if entry is not None and entry[0] == tuple(tokens[:length]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], length
+        self.misses += 1
+        return None, 0
+
+    def store(self, tokens, past):
+        """Offer the keys/values in past, which cover at least tokens, for caching.
+
+        Every block boundary of tokens counts as a sighting of that prefix, and
+        the longest prefix that was seen before is stored, so prompts that only
+        share their start still get that start cached.
+        """
+        keys = self.prefix_keys(tokens, min(len(tokens), past.shape[-2]))
+        if self.max_bytes <= 0:
+            return
+        admit = None
+        for length, key in keys:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                admit = None
+            elif key in self.seen:
+                self.seen.move_to_end(key)
+                admit = length, key
+            else:
+                self.seen[key] = True
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        if admit is None:
+            return
+
+        # A copy, so the rest of past isn't kept alive by a view
+        length, key = admit
+        self.seen.pop(key, None)
+        value = np.ascontiguousarray(past[..., :length, :])
+        self.entries[key] = (tuple(tokens[:length]), value)
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
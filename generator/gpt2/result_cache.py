@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+
+class ResultCache:
+    """Remembers the raw text generated for seeded requests.
+
+    A request with a seed always samples the same text, so it is keyed on the
+    model, the prompt tokens, the sampling settings and the seed. Entries are kept
+    in memory least recently used first and, if path is given, also written to a
+    directory there that is trimmed to max_disk_bytes.
+    """
+
+    def __init__(self, max_entries=1024, path=None, max_disk_bytes=64 * 2 ** 20):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(model_id, tokens, settings):
+        values = [model_id, [int(token) for token in tokens], sorted(settings.items())]
+        return hashlib.sha256(json.dumps(values).encode("utf-8")).hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """The cached text for key, or None."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        if self.path is not None:
+            try:
+                with open(self.file_path(key)) as f:
+                    text = json.load(f)
+            except (OSError, ValueError):
+                pass
+            else:
+                # Mark it as recently used for trim
+                os.utime(self.file_path(key))
+                self.hits += 1
+                self.remember(key, text)
+                return text
+
+        self.misses += 1
+        return None
+
+    def put(self, key, text):
+        self.remember(key, text)
+        if self.path is not None:
+            tmp_path = self.file_path(key) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(text, f)
+            os.replace(tmp_path, self.file_path(key))
+            self.trim()
+
+    def remember(self, key, text):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = text
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def trim(self):
+        """Delete the least recently used files until the directory fits max_disk_bytes."""
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.path, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
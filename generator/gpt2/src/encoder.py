@@ -1,7 +1,9 @@
 """Byte pair encoding utilities"""
 
+import heapq
 import json
 import os
+from collections import OrderedDict
 from functools import lru_cache
 
 import regex as re
@@ -47,15 +49,67 @@ def get_pairs(word):
     return pairs
 
 
+# Name of the file in the model directory that get_encoder pre-warms the cache from
+BPE_CACHE_FILE = "bpe_cache.json"
+
+
+class BPECache:
+    """Least recently used cache of the merges of pre-tokenized words.
+
+    Bounded to max_entries so a long running server doesn't grow forever, and
+    can be saved to and loaded from a JSON file so a restart starts warm.
+    """
+
+    def __init__(self, max_entries=2 ** 16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, token):
+        word = self.entries.get(token)
+        if word is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(token)
+        return word
+
+    def put(self, token, word):
+        if self.max_entries <= 0:
+            return
+        self.entries[token] = word
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def load(self, path):
+        """Add the entries of a file written by save, the first ones being most used."""
+        with open(path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        for token, word in reversed(entries[: self.max_entries]):
+            self.put(token, word)
+
+    def save(self, path):
+        entries = [[token, word] for token, word in reversed(self.entries.items())]
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors="replace"):
+    def __init__(self, encoder, bpe_merges, errors="replace", cache_size=2 ** 16):
         self.encoder = encoder
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.errors = errors  # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        self.bpe_merges = list(bpe_merges)
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache = BPECache(max_entries=cache_size)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(
@@ -63,50 +117,75 @@ class Encoder:
         )
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
+        if len(token) < 2:
             return token
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
+        # The symbols of the word as a linked list, a merge joins a symbol with
+        # the one after it and removes that one
+        symbols = list(token)
+        after = list(range(1, len(token))) + [-1]
+        before = list(range(-1, len(token) - 1))
+
+        # Positions of the adjacent pairs that have a merge, by rank, and a heap of
+        # those ranks. Positions are not removed when their pair changes, they are
+        # skipped when the rank comes up.
+        positions = {}
+        for i in range(len(token) - 1):
+            rank = self.bpe_ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                positions.setdefault(rank, []).append(i)
+        ranks = list(positions)
+        heapq.heapify(ranks)
+
+        while ranks:
+            # Like merging pairs one at a time would, every occurrence of the best
+            # pair is merged left to right before the pairs this creates count
+            rank = heapq.heappop(ranks)
+            first, second = self.bpe_merges[rank]
+            merged = []
+            for i in sorted(positions.pop(rank)):
+                j = after[i]
+                if symbols[i] != first or j == -1 or symbols[j] != second:
+                    continue
+                symbols[i] = first + second
+                symbols[j] = None
+                after[i] = after[j]
+                if after[j] != -1:
+                    before[after[j]] = i
+                merged.append(i)
+
+            for i in merged:
+                for left, right in [(before[i], i), (i, after[i])]:
+                    if left == -1 or right == -1:
+                        continue
+                    rank = self.bpe_ranks.get((symbols[left], symbols[right]))
+                    if rank is None:
+                        continue
+                    if rank not in positions:
+                        positions[rank] = []
+                        heapq.heappush(ranks, rank)
+                    positions[rank].append(left)
+
+        word = []
+        i = 0
+        while i != -1:
+            word.append(symbols[i])
+            i = after[i]
         word = " ".join(word)
-        self.cache[token] = word
+        self.cache.put(token, word)
         return word
 
+    def pretokenize(self, text):
+        """The words of text that bpe is run on, as byte-level unicode strings."""
+        for token in re.findall(self.pat, text):
+            yield "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+
     def encode(self, text):
         bpe_tokens = []
-        for token in re.findall(self.pat, text):
-            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+        for token in self.pretokenize(text):
             bpe_tokens.extend(
                 self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
             )
@@ -119,8 +198,16 @@ class Encoder:
         )
         return text
 
+    def tokens_containing(self, strings):
+        """Set of tokens whose text contains any of strings."""
+        return {
+            token
+            for token in self.decoder
+            if any(string in self.decode([token]) for string in strings)
+        }
+
 
-def get_encoder(model_name, models_dir):
+def get_encoder(model_name, models_dir, cache_size=2 ** 16):
     with open(os.path.join(models_dir, model_name, "encoder.json"), "r") as f:
         encoder = json.load(f)
     with open(
@@ -128,4 +215,8 @@ def get_encoder(model_name, models_dir):
     ) as f:
         bpe_data = f.read()
     bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]]
-    return Encoder(encoder=encoder, bpe_merges=bpe_merges,)
+    enc = Encoder(encoder=encoder, bpe_merges=bpe_merges, cache_size=cache_size)
+    cache_path = os.path.join(models_dir, model_name, BPE_CACHE_FILE)
+    if os.path.isfile(cache_path):
+        enc.cache.load(cache_path)
+    return enc
@@ -77,7 +77,7 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams):
+def attn(x, scope, n_state, *, past, hparams, mask=None):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
@@ -98,6 +98,9 @@ def attn(x, scope, n_state, *, past, hparams):
         _, _, nd, ns = shape_list(w)
         b = attention_mask(nd, ns, dtype=w.dtype)
         b = tf.reshape(b, [1, 1, nd, ns])
+        if mask is not None:
+            # Padding is never attended to. mask has shape [batch, src_sequence]
+            b = b * tf.cast(mask, w.dtype)[:, tf.newaxis, tf.newaxis, :]
         w = w * b - tf.cast(1e10, w.dtype) * (1 - b)
         return w
 
@@ -133,10 +136,69 @@ def mlp(x, scope, n_state, *, hparams):
         return h2
 
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, mask=None):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
-        a, present = attn(norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams)
+        a, present = attn(
+            norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams, mask=mask
+        )
+        x = x + a
+        m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams)
+        x = x + m
+        return x, present
+
+
+def write_column(buffer, x, position):
+    """Return buffer with column position along its third axis replaced by x.
+
+    buffer has shape [batch, heads, capacity, features] and x [batch, heads, features].
+    The scatter can update buffer in place instead of copying it.
+    """
+    batch, heads, _, _ = shape_list(buffer)
+    b, h = tf.meshgrid(tf.range(batch), tf.range(heads), indexing="ij")
+    indices = tf.stack([b, h, tf.fill([batch, heads], position)], axis=-1)
+    return tf.tensor_scatter_nd_update(buffer, indices, x)
+
+
+def decode_attn(x, scope, n_state, *, hparams, cache, position, bias):
+    """attn for a single token per row, x has shape [batch, features].
+
+    With one query there is nothing to hide causally, so the only masking is
+    bias, which is 0 for columns to attend to and -1e10 elsewhere. Heads are
+    split and merged by reshapes alone since the sequence axis has length 1.
+    """
+    assert x.shape.ndims == 2  # Should be [batch, features]
+    assert n_state % hparams.n_head == 0
+    batch = shape_list(x)[0]
+    features = n_state // hparams.n_head
+
+    with tf.variable_scope(scope):
+        c = conv1d(x, "c_attn", n_state * 3)
+        # q, k, v each of shape [batch, heads, features]
+        q, k, v = tf.unstack(tf.reshape(c, [batch, 3, hparams.n_head, features]), axis=1)
+        k = write_column(cache[0], k, position)
+        v = write_column(cache[1], v, position)
+
+        w = tf.matmul(q[:, :, tf.newaxis, :], k, transpose_b=True)
+        w = w * tf.rsqrt(tf.cast(features, w.dtype)) + bias
+        a = tf.matmul(softmax(w), v)
+        a = tf.reshape(a, [batch, n_state])
+        a = conv1d(a, "c_proj", n_state)
+        return a, [k, v]
+
+
+def decode_block(x, scope, *, hparams, cache, position, bias):
+    with tf.variable_scope(scope):
+        nx = x.shape[-1].value
+        a, present = decode_attn(
+            norm(x, "ln_1"),
+            "attn",
+            nx,
+            hparams=hparams,
+            cache=cache,
+            position=position,
+            bias=bias,
+        )
         x = x + a
         m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams)
         x = x + m
@@ -167,7 +229,14 @@ def positions_for(tokens, past_length):
     return expand_tile(past_length + tf.range(nsteps), batch_size)
 
 
-def model(hparams, X, past=None, scope="model", reuse=False):
+def positions_for_mask(mask, nsteps):
+    """Positions of the last nsteps tokens, counting only the unpadded tokens before each."""
+    positions = tf.cumsum(tf.cast(mask, tf.int32), axis=1, exclusive=True)
+    return positions[:, tf.shape(mask)[1] - nsteps :]
+
+
+def model(hparams, X, past=None, mask=None, scope="model", reuse=False):
+    """mask is an optional [batch, past + sequence] tensor, 1 for real tokens and 0 for padding."""
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -183,7 +252,11 @@ def model(hparams, X, past=None, scope="model", reuse=False):
             initializer=tf.random_normal_initializer(stddev=0.02),
         )
         past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        if mask is None:
+            positions = positions_for(X, past_length)
+        else:
+            positions = positions_for_mask(mask, sequence)
+        h = tf.gather(wte, X) + tf.gather(wpe, positions)
 
         # Transformer
         presents = []
@@ -192,7 +265,9 @@ def model(hparams, X, past=None, scope="model", reuse=False):
         )
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
-            h, present = block(h, "h%d" % layer, past=past, hparams=hparams)
+            h, present = block(
+                h, "h%d" % layer, past=past, hparams=hparams, mask=mask
+            )
             presents.append(present)
         results["present"] = tf.stack(presents, axis=1)
         h = norm(h, "ln_f")
@@ -203,3 +278,54 @@ def model(hparams, X, past=None, scope="model", reuse=False):
         logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
         results["logits"] = logits
         return results
+
+
+def decode(hparams, X, cache, position, mask, scope="model", reuse=False):
+    """Run the single token per row in X, found at column position.
+
+    Instead of growing a past, the keys/values live in preallocated buffers: cache
+    is a list with a keys and a values buffer for every layer, each of shape
+    [batch, heads, capacity, features], and mask has shape [batch, capacity].
+    Returns the logits and the updated buffers as "cache".
+    """
+    with tf.variable_scope(scope, reuse=reuse):
+        results = {}
+        batch = shape_list(X)[0]
+
+        wpe = tf.get_variable(
+            "wpe",
+            [hparams.n_ctx, hparams.n_embd],
+            initializer=tf.random_normal_initializer(stddev=0.01),
+        )
+        wte = tf.get_variable(
+            "wte",
+            [hparams.n_vocab, hparams.n_embd],
+            initializer=tf.random_normal_initializer(stddev=0.02),
+        )
+        # Columns after position hold no keys/values yet
+        capacity = tf.shape(mask)[1]
+        mask = mask * tf.cast(tf.range(capacity) <= position, mask.dtype)
+        positions = tf.cumsum(mask, axis=1, exclusive=True)[:, position]
+        h = tf.gather(wte, X[:, 0]) + tf.gather(wpe, positions)
+
+        # Shared by every layer, shape [batch, heads, 1, capacity]
+        bias = (tf.cast(mask, h.dtype)[:, tf.newaxis, tf.newaxis, :] - 1) * 1e10
+
+        # Transformer
+        presents = []
+        for layer in range(hparams.n_layer):
+            h, present = decode_block(
+                h,
+                "h%d" % layer,
+                hparams=hparams,
+                cache=cache[2 * layer : 2 * layer + 2],
+                position=position,
+                bias=bias,
+            )
+            presents.extend(present)
+        results["cache"] = presents
+        h = norm(h, "ln_f")
+
+        logits = tf.matmul(h, wte, transpose_b=True)
+        results["logits"] = logits[:, tf.newaxis, :]
+        return results
@@ -0,0 +1,192 @@
+"""The forward pass of model.py in plain NumPy, for running on CPU without TensorFlow.
+
+weights maps the TensorFlow variable names (e.g. "model/h0/attn/c_attn/w") to
+arrays, as returned by weights.load_weights. Matrices may also be int8 with a
+scale per output channel, as returned by weights.quantize_weights. Those only
+save memory: NumPy has no BLAS for integer matrix products, so they are turned
+back into float for every product, which is slower than float weights.
+"""
+
+import math
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class HParams(SimpleNamespace):
+    """Stand-in for tf.contrib.training.HParams."""
+
+    def override_from_dict(self, values):
+        self.__dict__.update(values)
+        return self
+
+
+def default_hparams():
+    return HParams(n_vocab=0, n_ctx=1024, n_embd=768, n_head=12, n_layer=12,)
+
+
+def past_shape(*, hparams, batch_size=None, sequence=None):
+    return [
+        batch_size,
+        hparams.n_layer,
+        2,
+        hparams.n_head,
+        sequence,
+        hparams.n_embd // hparams.n_head,
+    ]
+
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    ex = np.exp(x)
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+
+def gelu(x):
+    # A Python float, as a NumPy 2 float64 scalar would make the result float64
+    return 0.5 * x * (1 + np.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * x ** 3)))
+
+
+def norm(x, weights, scope, *, axis=-1, epsilon=1e-5):
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    u = np.mean(x, axis=axis, keepdims=True)
+    s = np.mean(np.square(x - u), axis=axis, keepdims=True)
+    x = (x - u) / np.sqrt(s + epsilon)
+    return x * weights[scope + "/g"] + weights[scope + "/b"]
+
+
+# Rows of an int8 matrix that are converted back to float at a time
+DEQUANTIZE_BLOCK = 8192
+
+
+def conv1d(x, weights, scope):
+    w = weights[scope + "/w"]
+    w = w.reshape(w.shape[-2:])
+    if w.dtype == np.int8:
+        # Scales are per output channel so they can be applied after the matmul
+        c = np.matmul(x, w.astype(x.dtype)) * weights[scope + "/w_scale"]
+    else:
+        c = np.matmul(x, w)
+    return c + weights[scope + "/b"]
+
+
+def embed(weights, X):
+    wte = weights["model/wte"]
+    if wte.dtype == np.int8:
+        return wte[X].astype(np.float32) * weights["model/wte_scale"][X][..., None]
+    return wte[X]
+
+
+def unembed(weights, h):
+    """Logits of h against every token embedding."""
+    wte = weights["model/wte"]
+    if wte.dtype != np.int8:
+        return np.matmul(h, wte.T)
+
+    # Dequantizing the whole vocabulary at once would need as much memory as
+    # the float weights, so it is done a block of tokens at a time.
+    scale = weights["model/wte_scale"]
+    logits = np.empty(h.shape[:-1] + wte.shape[:1], dtype=h.dtype)
+    for start in range(0, wte.shape[0], DEQUANTIZE_BLOCK):
+        block = wte[start : start + DEQUANTIZE_BLOCK].astype(h.dtype)
+        logits[..., start : start + DEQUANTIZE_BLOCK] = (
+            np.matmul(h, block.T) * scale[start : start + DEQUANTIZE_BLOCK]
+        )
+    return logits
+
+
+def attention_mask(nd, ns):
+    """True in the lower triangle, counting from the lower right corner."""
+    i = np.arange(nd)[:, None]
+    j = np.arange(ns)
+    return i >= j - ns + nd
+
+
+def attn(x, weights, scope, *, hparams, cache, layer, offset, mask=None):
+    """Attention that appends its keys/values to cache instead of returning them.
+
+    cache has shape [batch, layer, 2, heads, capacity, features] and already holds
+    the keys/values of the offset tokens before x.
+    """
+    batch, nd, n_state = x.shape
+    n_head = hparams.n_head
+
+    def split_heads(x):
+        # From [batch, sequence, features] to [batch, heads, sequence, features]
+        return x.reshape(batch, nd, n_head, n_state // n_head).transpose(0, 2, 1, 3)
+
+    c = conv1d(x, weights, scope + "/c_attn")
+    q, k, v = map(split_heads, np.split(c, 3, axis=-1))
+    ns = offset + nd
+    cache[:, layer, 0, :, offset:ns] = k
+    cache[:, layer, 1, :, offset:ns] = v
+    k = cache[:, layer, 0, :, :ns]
+    v = cache[:, layer, 1, :, :ns]
+
+    w = np.matmul(q, k.transpose(0, 1, 3, 2)) / np.sqrt(v.shape[-1], dtype=x.dtype)
+    if mask is not None:
+        # Padding is never attended to. mask has shape [batch, src_sequence]
+        b = mask[:, None, None, :ns].astype(bool)
+        if nd > 1:
+            b = b & attention_mask(nd, ns)[None, None]
+        w = np.where(b, w, np.asarray(-1e10, dtype=w.dtype))
+    elif nd > 1:
+        w = np.where(attention_mask(nd, ns)[None, None], w, np.asarray(-1e10, dtype=w.dtype))
+    a = np.matmul(softmax(w), v)
+
+    a = a.transpose(0, 2, 1, 3).reshape(batch, nd, n_state)
+    return conv1d(a, weights, scope + "/c_proj")
+
+
+def mlp(x, weights, scope):
+    h = gelu(conv1d(x, weights, scope + "/c_fc"))
+    return conv1d(h, weights, scope + "/c_proj")
+
+
+def block(x, weights, scope, *, hparams, cache, layer, offset, mask=None):
+    a = attn(
+        norm(x, weights, scope + "/ln_1"),
+        weights,
+        scope + "/attn",
+        hparams=hparams,
+        cache=cache,
+        layer=layer,
+        offset=offset,
+        mask=mask,
+    )
+    x = x + a
+    m = mlp(norm(x, weights, scope + "/ln_2"), weights, scope + "/mlp")
+    return x + m
+
+
+def positions_for(mask, offset, nsteps):
+    """Positions of tokens offset to offset + nsteps, counting only unpadded tokens."""
+    positions = np.cumsum(mask, axis=1) - mask
+    return positions[:, offset : offset + nsteps]
+
+
+def model(hparams, weights, X, cache, offset, mask, last=None):
+    """Run tokens X that follow the offset tokens already in cache.
+
+    mask has shape [batch, capacity] and is 1 for real tokens, 0 for padding.
+    Returns logits for every token of X, or only for its last tokens if last is set.
+    """
+    wpe = weights["model/wpe"]
+    h = embed(weights, X) + wpe[positions_for(mask, offset, X.shape[1])]
+
+    for layer in range(hparams.n_layer):
+        h = block(
+            h,
+            weights,
+            "model/h%d" % layer,
+            hparams=hparams,
+            cache=cache,
+            layer=layer,
+            offset=offset,
+            mask=mask,
+        )
+
+    if last is not None:
+        h = h[:, -last:]
+    h = norm(h, weights, "model/ln_f")
+    return unembed(weights, h)
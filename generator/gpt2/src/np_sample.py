@@ -0,0 +1,309 @@
+"""sample.py for the NumPy model, with the keys/values kept in one preallocated cache."""
+
+import numpy as np
+
+from generator.gpt2.src import np_model
+
+
+def per_row(value, logits):
+    """Broadcast a scalar or per row setting to shape [batch]."""
+    return np.broadcast_to(np.reshape(value, [-1]), logits.shape[:1])
+
+
+def penalize_used(logits, used):
+    return np.where(used, logits * 0.85, logits)
+
+
+def top_k_top_p_logits(logits, k, p):
+    """Top k truncation followed by top p (nucleus) truncation, only sorting the top
+    k of each row. k and p can be scalars or hold one value per row, 0 means no top
+    k truncation."""
+    k = per_row(k, logits)
+    p = per_row(p, logits)
+    logits = logits.copy()
+    for row in range(logits.shape[0]):
+        if k[row] > 0:
+            top = np.argpartition(logits[row], -k[row])[-k[row] :]
+            values = -np.sort(-logits[row, top])
+        else:
+            values = -np.sort(-logits[row])
+        cumulative_probs = np.cumsum(np_model.softmax(values))
+        # number of indices to include
+        keep = max(np.sum(cumulative_probs <= p[row]) - 1, 0)
+        logits[row][logits[row] < values[keep]] = -1e10
+    return logits
+
+
+def filter_logits(logits, temperature, used, top_k, top_p):
+    """The logits sampling actually draws from, temperature has shape [batch]."""
+    logits = logits / temperature[:, None]
+    logits = penalize_used(logits, used)
+    return top_k_top_p_logits(logits, top_k, top_p)
+
+
+def probabilities(logits):
+    return np_model.softmax(logits.astype(np.float64))
+
+
+# What a seeded row's noise is drawn for, so no two draws at a position share it
+SAMPLE, DRAFT, ACCEPT, RESIDUAL = range(4)
+
+
+def uniform(rng, seed, positions, stream=SAMPLE):
+    """One uniform sample per row, for a token at positions (one per row).
+
+    seed is None or holds a seed or None per row. Seeded rows draw from noise
+    seeded by (seed, position, stream), so what they sample at a position doesn't
+    depend on the other rows or on how many calls the generation was split into.
+    """
+    u = rng.random_sample([len(positions)])
+    if seed is not None:
+        for row, row_seed in enumerate(seed):
+            if row_seed is not None:
+                row_rng = np.random.RandomState(
+                    [row_seed % 2 ** 32, int(positions[row]), stream]
+                )
+                u[row] = row_rng.random_sample()
+    return u
+
+
+def categorical(probs, u):
+    """One sample per row of probs, picked by the uniform samples u."""
+    samples = np.sum(np.cumsum(probs, axis=-1) < u[:, None], axis=-1)
+    return np.minimum(samples, probs.shape[-1] - 1).astype(np.int32)
+
+
+def sample_sequence(
+    *,
+    hparams,
+    weights,
+    length,
+    context,
+    past=None,
+    mask=None,
+    temperature=1,
+    top_k=0,
+    top_p=1,
+    stop_tokens=(),
+    sentence_tokens=(),
+    max_sentences=0,
+    end_token=None,
+    seed=None,
+    rng=np.random
+):
+    """Same as sample.sample_sequence with return_presents=True, on NumPy arrays.
+
+    seed holds an int or None per row, see uniform. Unseeded rows draw from rng.
+    """
+    batch, width = context.shape
+    past_length = 0 if past is None else past.shape[-2]
+    if mask is None:
+        mask = np.ones_like(context)
+
+    capacity = width + length
+    cache = np.zeros(
+        np_model.past_shape(hparams=hparams, batch_size=batch, sequence=capacity),
+        dtype=np.float32,
+    )
+    if past_length > 0:
+        cache[..., :past_length, :] = past
+    tokens = np.zeros([batch, capacity], dtype=np.int32)
+    tokens[:, :width] = context
+    full_mask = np.ones([batch, capacity], dtype=np.int32)
+    full_mask[:, :width] = mask
+
+    # Tokens already used in each row, kept up to date one sample at a time
+    used = np.zeros([batch, hparams.n_vocab], dtype=bool)
+    rows = np.repeat(np.arange(batch), width)
+    real = mask.reshape(-1).astype(bool)
+    used[rows[real], context.reshape(-1)[real]] = True
+
+    stop_tokens = np.asarray(sorted(stop_tokens), dtype=np.int32)
+    sentence_tokens = np.asarray(sorted(sentence_tokens), dtype=np.int32)
+    temperature = per_row(temperature, context).astype(np.float32)
+    finished = np.zeros([batch], dtype=bool)
+    sentences = np.zeros([batch], dtype=np.int32)
+    # Position of the next sample in each row, not counting padding
+    positions = mask.sum(axis=1)
+
+    offset, end = past_length, width
+    for _ in range(length):
+        logits = np_model.model(
+            hparams,
+            weights,
+            tokens[:, offset:end],
+            cache,
+            offset,
+            full_mask,
+            last=1,
+        )[:, -1, : hparams.n_vocab]
+        logits = filter_logits(logits, temperature, used, top_k, top_p)
+        samples = categorical(probabilities(logits), uniform(rng, seed, positions))
+        if end_token is not None:
+            samples = np.where(finished, end_token, samples)
+
+        tokens[:, end] = samples
+        used[np.arange(batch), samples] = True
+        sentences += np.isin(samples, sentence_tokens)
+        finished |= np.isin(samples, stop_tokens)
+        if max_sentences > 0:
+            finished |= sentences >= max_sentences
+        offset, end = end, end + 1
+        positions = positions + 1
+        if finished.all():
+            break
+
+    # Like the TensorFlow graph, the keys/values of the last sample were never computed
+    return tokens[:, :end], cache[..., : end - 1, :]
+
+
+def speculative_sample_sequence(
+    *,
+    hparams,
+    weights,
+    draft_hparams,
+    draft_weights,
+    draft_length=4,
+    length,
+    context,
+    past=None,
+    mask=None,
+    temperature=1,
+    top_k=0,
+    top_p=1,
+    stop_tokens=(),
+    sentence_tokens=(),
+    max_sentences=0,
+    end_token=None,
+    seed=None,
+    rng=np.random
+):
+    """sample_sequence with a smaller draft model proposing draft_length + 1 tokens at a time.
+
+    One run of the full model scores every proposal. Proposal x drawn with draft
+    probability q(x) is kept with probability min(1, p(x) / q(x)) under the full
+    model's p, and the first rejected one is replaced by a sample of
+    max(p - q, 0), so the samples follow exactly the distribution of
+    sample_sequence. Both models must share the encoder.
+
+    Every token goes through the same draft, accept and replace steps with noise
+    drawn for its position, so seeded rows sample the same however far the other
+    rows of the batch get each round.
+    """
+    batch, width = context.shape
+    past_length = 0 if past is None else past.shape[-2]
+    if mask is None:
+        mask = np.ones_like(context)
+
+    capacity = width + length
+    cache = np.zeros(
+        np_model.past_shape(hparams=hparams, batch_size=batch, sequence=capacity),
+        dtype=np.float32,
+    )
+    if past_length > 0:
+        cache[..., :past_length, :] = past
+    draft_cache = np.zeros(
+        np_model.past_shape(hparams=draft_hparams, batch_size=batch, sequence=capacity),
+        dtype=np.float32,
+    )
+    tokens = np.zeros([batch, capacity], dtype=np.int32)
+    tokens[:, :width] = context
+    full_mask = np.ones([batch, capacity], dtype=np.int32)
+    full_mask[:, :width] = mask
+
+    used = np.zeros([batch, hparams.n_vocab], dtype=bool)
+    rows = np.repeat(np.arange(batch), width)
+    real = mask.reshape(-1).astype(bool)
+    used[rows[real], context.reshape(-1)[real]] = True
+
+    stop_tokens = np.asarray(sorted(stop_tokens), dtype=np.int32)
+    sentence_tokens = np.asarray(sorted(sentence_tokens), dtype=np.int32)
+    temperature = per_row(temperature, context).astype(np.float32)
+    finished = np.zeros([batch], dtype=bool)
+    sentences = np.zeros([batch], dtype=np.int32)
+    everyone = np.arange(batch)
+    # Position of the token at column width in each row, not counting padding
+    first_position = mask.sum(axis=1)
+
+    # The first offset columns of cache, and draft_offset of draft_cache, are final
+    offset, draft_offset, end = past_length, 0, width
+    while end < capacity and not finished.all():
+        # The full model scores k + 1 proposals: the k it is run on and one more
+        k = min(draft_length, capacity - end - 1)
+        positions = first_position + end - width
+
+        # Draft k + 1 tokens, remembering the used tokens each was drawn with
+        draft_used = [used]
+        draft_probs = []
+        for i in range(k + 1):
+            logits = np_model.model(
+                draft_hparams,
+                draft_weights,
+                tokens[:, draft_offset : end + i],
+                draft_cache,
+                draft_offset,
+                full_mask,
+                last=1,
+            )[:, -1, : hparams.n_vocab]
+            probs = probabilities(
+                filter_logits(logits, temperature, draft_used[i], top_k, top_p)
+            )
+            samples = categorical(probs, uniform(rng, seed, positions + i, DRAFT))
+            tokens[:, end + i] = samples
+            draft_probs.append(probs)
+            draft_used.append(draft_used[i].copy())
+            draft_used[-1][everyone, samples] = True
+            draft_offset = end + i
+
+        # Score all of them in one run
+        logits = np_model.model(
+            hparams,
+            weights,
+            tokens[:, offset : end + k],
+            cache,
+            offset,
+            full_mask,
+            last=k + 1,
+        )[:, :, : hparams.n_vocab]
+
+        samples = np.zeros([batch, k + 1], dtype=np.int32)
+        accepted = np.full([batch], k)
+        for i in range(k + 1):
+            probs = probabilities(
+                filter_logits(logits[:, i], temperature, draft_used[i], top_k, top_p)
+            )
+            drafted = tokens[:, end + i]
+            ratio = probs[everyone, drafted] / draft_probs[i][everyone, drafted]
+            u = uniform(rng, seed, positions + i, ACCEPT)
+            rejected = (u >= ratio) & (accepted == k)
+            residual = np.maximum(probs - draft_probs[i], 0)
+            total = residual.sum(axis=-1, keepdims=True)
+            residual = np.where(total > 0, residual / np.maximum(total, 1e-300), probs)
+            u = uniform(rng, seed, positions + i, RESIDUAL)
+            samples[:, i] = np.where(rejected, categorical(residual, u), drafted)
+            accepted[rejected] = i
+
+        # Every row keeps the same number of tokens so the caches stay aligned.
+        # A prefix of a row's samples is itself a correct sample.
+        n = np.min(accepted[~finished]) + 1
+        for i in range(n):
+            column = samples[:, i]
+            if end_token is not None:
+                column = np.where(finished, end_token, column)
+            tokens[:, end + i] = column
+            used[everyone, column] = True
+            sentences += np.isin(column, sentence_tokens)
+            finished |= np.isin(column, stop_tokens)
+            if max_sentences > 0:
+                finished |= sentences >= max_sentences
+            if finished.all():
+                n = i + 1
+                break
+
+        # Keys/values past the last kept draft token were computed for tokens
+        # that may have been replaced, and get overwritten by the next run
+        offset = end + n - 1
+        draft_offset = min(draft_offset, offset)
+        end += n
+
+    return tokens[:, :end], cache[..., : end - 1, :]
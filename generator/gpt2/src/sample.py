@@ -2,41 +2,34 @@ import tensorflow as tf
 from generator.gpt2.src import model
 
 
-def penalize_used(logits, output):
+def used_tokens(output, mask, n_vocab):
+    """[batch, n_vocab] bools marking the tokens found in each row of output.
 
-    # I want to change the indices of logits wherever the index is found in output
-    change_tensor = tf.zeros_like(logits, dtype=logits.dtype)
-    unique = tf.unique(output[0])[0]
-    ones = tf.ones_like(unique, dtype=unique.dtype)
-    indices = tf.expand_dims(unique, 1)
+    Repeated tokens just add up in the scatter, padding adds 0.
+    """
+    batch, sequence = model.shape_list(output)
+    rows = tf.tile(tf.range(batch)[:, tf.newaxis], [1, sequence])
+    indices = tf.reshape(tf.stack([rows, output], axis=-1), [-1, 2])
+    counts = tf.reshape(tf.cast(mask, tf.int32), [-1])
+    updates = tf.scatter_nd(indices, counts, [batch, n_vocab])
+    return tf.cast(updates, tf.bool)
 
-    updates = tf.scatter_nd(indices, ones, [logits.shape[1]])
 
-    bool_tensor = tf.expand_dims(tf.cast(updates, tf.bool), 0)
+def penalize_used(logits, used):
 
-    return tf.compat.v1.where(bool_tensor, logits * 0.85, logits)
+    # I want to change the indices of logits wherever the token was already used
+    return tf.compat.v1.where(used, logits * 0.85, logits)
 
 
-def top_k_logits(logits, k):
-    if k == 0:
-        # no truncation
-        return logits
-
-    def _top_k():
-        values, _ = tf.nn.top_k(logits, k=k)
-        min_values = values[:, -1, tf.newaxis]
-        return tf.where(
-            logits < min_values,
-            tf.ones_like(logits, dtype=logits.dtype) * -1e10,
-            logits,
-        )
-
-    return tf.cond(tf.equal(k, 0), lambda: logits, lambda: _top_k(),)
+def per_row(value, logits):
+    """Broadcast a scalar or per row setting to shape [batch]."""
+    return tf.broadcast_to(tf.reshape(value, [-1]), tf.shape(logits)[:1])
 
 
 def top_p_logits(logits, p):
-    """Nucleus sampling"""
-    batch, _ = logits.shape.as_list()
+    """Nucleus sampling, p can be a scalar or hold one value per row."""
+    batch = tf.shape(logits)[0]
+    p = per_row(p, logits)
     sorted_logits = tf.sort(logits, direction="DESCENDING", axis=-1)
     cumulative_probs = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1)
     indices = tf.stack(
@@ -44,15 +37,70 @@ def top_p_logits(logits, p):
             tf.range(0, batch),
             # number of indices to include
             tf.maximum(
-                tf.reduce_sum(tf.cast(cumulative_probs <= p, tf.int32), axis=-1) - 1, 0
+                tf.reduce_sum(
+                    tf.cast(cumulative_probs <= p[:, tf.newaxis], tf.int32), axis=-1
+                )
+                - 1,
+                0,
             ),
         ],
         axis=-1,
     )
-    min_values = tf.gather_nd(sorted_logits, indices)
+    min_values = tf.gather_nd(sorted_logits, indices)[:, tf.newaxis]
     return tf.where(logits < min_values, tf.ones_like(logits) * -1e10, logits,)
 
 
+def top_k_top_p_logits(logits, k, p):
+    """Top k truncation followed by top_p_logits, without sorting the whole vocabulary.
+
+    After top k truncation only k tokens have any probability left, so the nucleus
+    cutoff is found among the k largest logits. Rows with k = 0 fall back to
+    considering every token.
+    """
+    if isinstance(k, int) and k == 0:
+        return top_p_logits(logits, p)
+
+    batch, n_vocab = tf.shape(logits)[0], tf.shape(logits)[1]
+    k = per_row(k, logits)
+    k = tf.where(k > 0, k, tf.fill(tf.shape(k), n_vocab))
+    p = per_row(p, logits)
+
+    # Sorted in descending order, positions past a row's own k don't count
+    values, _ = tf.nn.top_k(logits, k=tf.reduce_max(k))
+    in_top_k = tf.range(tf.shape(values)[1])[tf.newaxis, :] < k[:, tf.newaxis]
+    values = tf.where(in_top_k, values, tf.ones_like(values) * -1e10)
+
+    cumulative_probs = tf.cumsum(tf.nn.softmax(values, axis=-1), axis=-1)
+    # number of indices to include, never more than the top k
+    keep = tf.reduce_sum(
+        tf.cast(cumulative_probs <= p[:, tf.newaxis], tf.int32), axis=-1
+    )
+    keep = tf.clip_by_value(keep - 1, 0, k - 1)
+    min_values = tf.gather_nd(values, tf.stack([tf.range(0, batch), keep], axis=-1))
+    return tf.where(
+        logits < min_values[:, tf.newaxis], tf.ones_like(logits) * -1e10, logits,
+    )
+
+
+def seeded_multinomial(logits, seed, count):
+    """tf.multinomial with one sample per row, drawn from noise seeded by (seed, count).
+
+    seed and count have shape [batch], so each row samples the same whatever other
+    rows share its batch. Uses the Gumbel-max trick on stateless uniform noise.
+    """
+    n_vocab = tf.shape(logits)[1]
+    seeds = tf.stack([seed, count], axis=1)
+    u = tf.map_fn(
+        lambda row_seed: tf.random.stateless_uniform(
+            [n_vocab], seed=row_seed, minval=1e-20, maxval=1.0
+        ),
+        seeds,
+        dtype=tf.float32,
+    )
+    samples = tf.argmax(logits - tf.log(-tf.log(u)), axis=-1, output_type=tf.int32)
+    return samples[:, tf.newaxis]
+
+
 def sample_sequence(
     *,
     hparams,
@@ -60,19 +108,53 @@ def sample_sequence(
     start_token=None,
     batch_size=None,
     context=None,
+    past=None,
+    mask=None,
     temperature=1,
     top_k=0,
-    top_p=1
+    top_p=1.0,
+    stop_tokens=(),
+    sentence_tokens=(),
+    max_sentences=0,
+    end_token=None,
+    seed=None,
+    return_presents=False
 ):
+    """Sample up to length tokens after context.
+
+    Sampling stops early once every row has produced one of stop_tokens or, if
+    max_sentences is set, that many of sentence_tokens. Rows that finish before
+    the others get end_token appended instead of further samples.
+
+    With seed, an int per row, sampling is deterministic: each sample is drawn
+    from noise seeded by the row's seed and its number of tokens so far. Rows
+    with a negative seed are sampled as without one.
+    """
     if start_token is None:
         assert context is not None, "Specify exactly one of start_token and context!"
     else:
         assert context is None, "Specify exactly one of start_token and context!"
         context = tf.fill([batch_size, 1], start_token)
 
-    def step(hparams, tokens, past=None):
+    # context always includes the columns covered by past. Rows of different
+    # lengths are left padded and mask marks which columns hold real tokens.
+    if mask is None:
+        mask = tf.ones_like(context)
+
+    stop_tokens = tf.constant(stop_tokens, dtype=tf.int32, shape=[len(stop_tokens)])
+    sentence_tokens = tf.constant(
+        sentence_tokens, dtype=tf.int32, shape=[len(sentence_tokens)]
+    )
+
+    def contains(samples, tokens):
+        # samples has shape [batch, 1], and so does the result
+        return tf.reduce_any(
+            tf.equal(samples, tokens[tf.newaxis, :]), axis=1, keepdims=True
+        )
+
+    def step(hparams, tokens, past=None, mask=None):
         lm_output = model.model(
-            hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE
+            hparams=hparams, X=tokens, past=past, mask=mask, reuse=tf.AUTO_REUSE
         )
 
         logits = lm_output["logits"][:, :, : hparams.n_vocab]
@@ -85,39 +167,130 @@ def sample_sequence(
 
     with tf.name_scope("sample_sequence"):
 
-        def body(past, prev, output):
-            next_outputs = step(hparams, prev, past=past)
-            logits = next_outputs["logits"][:, -1, :] / tf.to_float(temperature)
-            logits = penalize_used(logits, output)
-            logits = top_k_logits(logits, k=top_k)
-            logits = top_p_logits(logits, p=top_p)
+        def sample(logits, used, finished, sentences, count):
+            logits = logits / tf.to_float(per_row(temperature, logits))[:, tf.newaxis]
+            logits = penalize_used(logits, used)
+            logits = top_k_top_p_logits(logits, k=top_k, p=top_p)
             samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+            if seed is not None:
+                # The per-row noise is only drawn for batches with a seeded row
+                seeded = seed >= 0
+                samples = tf.cond(
+                    tf.reduce_any(seeded),
+                    lambda: tf.where(
+                        seeded, seeded_multinomial(logits, seed, count), samples
+                    ),
+                    lambda: samples,
+                )
+            if end_token is not None:
+                samples = tf.where(
+                    finished, tf.fill(tf.shape(samples), end_token), samples
+                )
+
+            # Only the new samples need to be added to the used tokens
+            used = tf.logical_or(
+                used, tf.one_hot(samples[:, 0], hparams.n_vocab, True, False)
+            )
+            sentences += tf.cast(contains(samples, sentence_tokens), tf.int32)
+            finished = tf.logical_or(finished, contains(samples, stop_tokens))
+            if max_sentences > 0:
+                finished = tf.logical_or(finished, sentences >= max_sentences)
+            return samples, used, finished, sentences
+
+        # Run the whole context once
+        if past is None:
+            next_outputs = step(hparams, context, mask=mask)
+            presents = next_outputs["presents"]
+        else:
+            # The cached past already covers the start of the context, only run the rest
+            next_outputs = step(
+                hparams, context[:, tf.shape(past)[-2] :], past=past, mask=mask
+            )
+            presents = tf.concat([past, next_outputs["presents"]], axis=-2)
+
+        used = used_tokens(context, mask, hparams.n_vocab)
+        finished = tf.zeros([tf.shape(context)[0], 1], dtype=tf.bool)
+        sentences = tf.zeros([tf.shape(context)[0], 1], dtype=tf.int32)
+        # Number of real tokens in each row, for seeding
+        count = tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
+        samples, used, finished, sentences = sample(
+            next_outputs["logits"][:, -1, :], used, finished, sentences, count
+        )
+
+        # Then decode one token at a time into keys/values buffers big enough for
+        # every sample, so no step has to copy what earlier steps computed
+        full_mask = tf.concat(
+            [mask, tf.ones([tf.shape(context)[0], length], dtype=mask.dtype)], axis=1
+        )
+        presents = tf.pad(
+            presents, [[0, 0], [0, 0], [0, 0], [0, 0], [0, length], [0, 0]]
+        )
+        cache = []
+        for layer in tf.unstack(presents, axis=1):
+            cache.extend(tf.unstack(layer, axis=1))
+
+        def body(cache, prev, output, used, finished, sentences):
+            lm_output = model.decode(
+                hparams=hparams,
+                X=prev,
+                cache=cache,
+                position=tf.shape(output)[1] - 1,
+                mask=full_mask,
+                reuse=tf.AUTO_REUSE,
+            )
+            logits = lm_output["logits"][:, -1, : hparams.n_vocab]
+            samples, used, finished, sentences = sample(
+                logits,
+                used,
+                finished,
+                sentences,
+                count + tf.shape(output)[1] - tf.shape(context)[1],
+            )
             return [
-                next_outputs["presents"]
-                if past is None
-                else tf.concat([past, next_outputs["presents"]], axis=-2),
+                lm_output["cache"],
                 samples,
                 tf.concat([output, samples], axis=1),
+                used,
+                finished,
+                sentences,
             ]
 
-        past, prev, output = body(None, context, context)
-
-        def cond(*args):
-            return True
+        def cond(cache, prev, output, used, finished, sentences):
+            return tf.logical_not(tf.reduce_all(finished))
 
-        _, _, tokens = tf.while_loop(
+        buffer_shape = [batch_size, hparams.n_head, None, hparams.n_embd // hparams.n_head]
+        cache, _, tokens, _, _, _ = tf.while_loop(
             cond=cond,
             body=body,
             maximum_iterations=length - 1,
-            loop_vars=[past, prev, output],
+            loop_vars=[
+                cache,
+                samples,
+                tf.concat([context, samples], axis=1),
+                used,
+                finished,
+                sentences,
+            ],
             shape_invariants=[
-                tf.TensorShape(
-                    model.past_shape(hparams=hparams, batch_size=batch_size)
-                ),
+                [tf.TensorShape(buffer_shape)] * len(cache),
                 tf.TensorShape([batch_size, None]),
                 tf.TensorShape([batch_size, None]),
+                tf.TensorShape([batch_size, hparams.n_vocab]),
+                tf.TensorShape([batch_size, 1]),
+                tf.TensorShape([batch_size, 1]),
             ],
             back_prop=False,
         )
 
+        if return_presents:
+            # Back to [batch, layer, 2, heads, sequence, features], covering every
+            # token but the last sample
+            presents = tf.stack(
+                [
+                    tf.stack(cache[layer : layer + 2], axis=1)
+                    for layer in range(0, len(cache), 2)
+                ],
+                axis=1,
+            )
+            return tokens, presents[..., : tf.shape(tokens)[1] - 1, :]
         return tokens
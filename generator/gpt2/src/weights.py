@@ -0,0 +1,113 @@
+"""Model weights stored as one flat file that is memory-mapped instead of read"""
+
+import json
+import os
+
+import numpy as np
+
+# Matrices that hold nearly all of the weights and can be stored as int8
+QUANTIZED = ("/c_attn/w", "/c_proj/w", "/c_fc/w", "model/wte")
+
+INDEX_FILE = "weights.json"
+DATA_FILE = "weights.bin"
+QUANTIZED_INDEX_FILE = "weights_int8.json"
+QUANTIZED_DATA_FILE = "weights_int8.bin"
+ALIGNMENT = 64
+
+
+def weight_files(model_path, quantized=False):
+    """Paths of the index and data file, for the float or the int8 weights."""
+    if quantized:
+        return (
+            os.path.join(model_path, QUANTIZED_INDEX_FILE),
+            os.path.join(model_path, QUANTIZED_DATA_FILE),
+        )
+    return os.path.join(model_path, INDEX_FILE), os.path.join(model_path, DATA_FILE)
+
+
+def has_weights(model_path, quantized=False):
+    return os.path.isfile(weight_files(model_path, quantized)[0])
+
+
+def save_weights(weights, model_path, quantized=False):
+    """Write (name, array) pairs in the layout load_weights maps.
+
+    weights can be a generator so only one array has to be in memory at a time.
+    """
+    index = {}
+    offset = 0
+    index_path, data_path = weight_files(model_path, quantized)
+    with open(data_path + ".tmp", "wb") as f:
+        for name, value in weights:
+            value = np.ascontiguousarray(value)
+            padding = -offset % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            f.write(value.tobytes())
+            index[name] = {
+                "offset": offset,
+                "shape": list(value.shape),
+                "dtype": value.dtype.str,
+            }
+            offset += value.nbytes
+
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    # The index is written last so a half finished conversion is never picked up
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def load_weights(model_path, quantized=False):
+    """Map the weights written by save_weights as read-only arrays, by name.
+
+    The mapping is shared, so every process that maps the same file is backed
+    by the same pages of the page cache instead of holding its own copy.
+    """
+    index_path, data_path = weight_files(model_path, quantized)
+    with open(index_path) as f:
+        index = json.load(f)
+    data = np.memmap(data_path, dtype=np.uint8, mode="r")
+
+    weights = {}
+    for name, entry in index.items():
+        dtype = np.dtype(entry["dtype"])
+        size = int(np.prod(entry["shape"])) * dtype.itemsize
+        start = entry["offset"]
+        weights[name] = data[start : start + size].view(dtype).reshape(entry["shape"])
+    return weights
+
+
+def quantize(value, axis):
+    """int8 version of value with one scale per slice along axis.
+
+    value is approximately quantized * scale, with scale broadcast along axis.
+    """
+    reduce_axes = tuple(i for i in range(value.ndim) if i != axis % value.ndim)
+    scale = np.max(np.abs(value), axis=reduce_axes) / 127
+    scale = np.where(scale == 0, 1, scale).astype(np.float32)
+    shape = [1] * value.ndim
+    shape[axis] = -1
+    quantized = np.round(value / scale.reshape(shape))
+    return np.clip(quantized, -127, 127).astype(np.int8), scale
+
+
+def quantize_items(weights):
+    """Like quantize_weights for (name, array) pairs, yielding pairs as it goes."""
+    for name, value in weights:
+        if name.endswith(QUANTIZED):
+            axis = 0 if name == "model/wte" else -1
+            value, scale = quantize(value, axis)
+            yield name, value
+            yield name + "_scale", scale
+        else:
+            yield name, value
+
+
+def quantize_weights(weights):
+    """Store the big matrices of weights as int8, adding a name + "_scale" per matrix.
+
+    Convolution weights get a scale per output channel and wte one per token, so
+    both the embedding lookup and the logits can apply it after the fact.
+    """
+    return dict(quantize_items(weights.items()))
@@ -0,0 +1,99 @@
+import tensorflow as tf
+from generator.gpt2.src import model, sample, weights
+
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+
+class TFSampler:
+    """Runs sample.sample_sequence in a TensorFlow session."""
+
+    def __init__(
+        self,
+        hparams,
+        model_path,
+        *,
+        stop_tokens,
+        sentence_tokens,
+        max_sentences,
+        end_token,
+        force_cpu=False
+    ):
+        config = None
+        if force_cpu:
+            config = tf.compat.v1.ConfigProto(
+                device_count={"GPU": 0}
+            )
+        else:
+            config = tf.compat.v1.ConfigProto()
+            config.gpu_options.allow_growth = True
+        self.sess = tf.compat.v1.Session(config=config)
+
+        self.context = tf.placeholder(tf.int32, [None, None])
+        self.mask = tf.placeholder(tf.int32, [None, None])
+        self.past = tf.placeholder(tf.float32, model.past_shape(hparams=hparams))
+        # Sampling settings are fed per call (and per row) so one model serves them all
+        self.sampling = {
+            "temperature": tf.placeholder(tf.float32, [None]),
+            "top_k": tf.placeholder(tf.int32, [None]),
+            "top_p": tf.placeholder(tf.float32, [None]),
+            "generate_num": tf.placeholder(tf.int32, []),
+            "seed": tf.placeholder(tf.int32, [None]),
+        }
+        self.output, self.presents = sample.sample_sequence(
+            hparams=hparams,
+            length=self.sampling["generate_num"],
+            context=self.context,
+            past=self.past,
+            mask=self.mask,
+            temperature=self.sampling["temperature"],
+            top_k=self.sampling["top_k"],
+            top_p=self.sampling["top_p"],
+            stop_tokens=sorted(stop_tokens),
+            sentence_tokens=sorted(sentence_tokens),
+            max_sentences=max_sentences,
+            end_token=end_token,
+            seed=self.sampling["seed"],
+            return_presents=True,
+        )
+        self.presents_handle = tf.get_session_handle(self.presents)
+
+        if weights.has_weights(model_path):
+            # Weights converted with convert_weights.py are mapped, not parsed
+            mapped = weights.load_weights(model_path)
+            # All in one run: each variable.load would be a run of its own, and
+            # every new run signature prunes the whole sampling graph again
+            variables = tf.global_variables()
+            self.sess.run(
+                [variable.initializer for variable in variables],
+                {
+                    variable.initializer.inputs[1]: mapped[variable.op.name]
+                    for variable in variables
+                },
+            )
+        else:
+            saver = tf.train.Saver()
+            ckpt = tf.train.latest_checkpoint(model_path)
+            saver.restore(self.sess, ckpt)
+
+    def sample(self, context, mask, past, settings, length, keep_past=False):
+        """Returns the context followed by the samples, and the presents of both.
+
+        With keep_past the presents stay in the session and a handle to them is
+        returned instead, which can be passed back as past without copying them
+        out and back in. fetch_past gets their values.
+        """
+        feed_dict = {self.context: context, self.mask: mask, self.past: past}
+        for name in ["temperature", "top_k", "top_p"]:
+            feed_dict[self.sampling[name]] = settings[name]
+        feed_dict[self.sampling["generate_num"]] = length
+        # Rows without a seed are marked with -1 and use tf.multinomial
+        feed_dict[self.sampling["seed"]] = [
+            -1 if seed is None else seed % 2 ** 31 for seed in settings["seed"]
+        ]
+        presents = self.presents_handle if keep_past else self.presents
+        return self.sess.run([self.output, presents], feed_dict=feed_dict)
+
+    @staticmethod
+    def fetch_past(past):
+        """The values of presents kept by sample."""
+        return past.eval()
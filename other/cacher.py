@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+class Cacher:
+    """Local store of the story starts and action results of constrained games.
+
+    Each entry is keyed by the story seed, the choices made so far and its kind
+    ("story" or "choices"), and written to a file named by the hash of that key
+    under path (default cache/<bucket_name> in the working directory, which git
+    ignores). Files are written to a temporary name and renamed, so concurrent
+    readers never see half an entry. Once the files take more than max_bytes, the
+    least recently used are deleted.
+
+    credentials_file is accepted for compatibility with the old cloud bucket
+    cacher and ignored.
+    """
+
+    def __init__(
+        self, credentials_file=None, bucket_name="dungeon-cache", path=None, max_bytes=2 ** 30
+    ):
+        if path is None:
+            path = os.path.join("cache", bucket_name)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self.nbytes = sum(size for _, size, _ in self.files())
+
+    @staticmethod
+    def key(seed, choices, kind):
+        values = [seed, [int(choice) for choice in choices], kind]
+        return hashlib.sha256(json.dumps(values).encode("utf-8")).hexdigest()
+
+    def file_path(self, key):
+        # Spread over subdirectories so none of them gets too large
+        return os.path.join(self.path, key[:2], key + ".txt")
+
+    def files(self):
+        """(last used, size, path) of every entry on disk."""
+        files = []
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(".txt"):
+                    file_path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, file_path))
+        return files
+
+    def retrieve_from_cache(self, seed, choices, kind):
+        """The cached text for (seed, choices, kind), or None."""
+        file_path = self.file_path(self.key(seed, choices, kind))
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                text = f.read()
+            # Mark it as recently used for trim
+            os.utime(file_path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text
+
+    def cache_file(self, seed, choices, text, kind):
+        file_path = self.file_path(self.key(seed, choices, kind))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        self.nbytes += os.path.getsize(tmp_path)
+        if os.path.exists(file_path):
+            self.nbytes -= os.path.getsize(file_path)
+        os.replace(tmp_path, file_path)
+        if self.nbytes > self.max_bytes:
+            self.trim()
+
+    def trim(self):
+        """Delete the least recently used files until they fit max_bytes."""
+        files = self.files()
+        self.nbytes = sum(size for _, size, _ in files)
+        for _, size, file_path in sorted(files):
+            if self.nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            self.nbytes -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "bytes": self.nbytes,
+        }
@@ -4,9 +4,11 @@ import random
 import sys
 import time
 import argparse
+import logging
 
 from generator.gpt2.gpt2_generator import *
 from story import grammars
+from story.opening_pool import OpeningPool
 from story.story_manager import *
 from story.utils import *
 
@@ -18,6 +20,33 @@ parser.add_argument(
     action="store_true",
     help="Force using CPU instead of GPU."
 )
+parser.add_argument(
+    "--numpy",
+    action="store_true",
+    help="Run the model with NumPy on the CPU instead of TensorFlow (needs converted weights)."
+)
+parser.add_argument(
+    "--int8",
+    action="store_true",
+    help="Keep the weights of the NumPy backend as int8, using about a quarter of the memory but sampling up to half as fast."
+)
+parser.add_argument(
+    "--timing-log",
+    metavar="FILE",
+    help="Append a JSON line with the time spent in each stage of every turn to FILE."
+)
+parser.add_argument(
+    "--draft",
+    metavar="MODEL",
+    help="Let a smaller model in generator/gpt2/models draft tokens for the NumPy backend to verify."
+)
+parser.add_argument(
+    "--opening-pool",
+    type=int,
+    default=0,
+    metavar="N",
+    help="Generate up to N openings per setting and character while idle, so new games start instantly."
+)
 
 
 def splash():
@@ -172,8 +201,18 @@ def play_aidungeon_2(args):
     upload_story = True
 
     print("\nInitializing AI Dungeon! (This might take a few minutes)\n")
-    generator = GPT2Generator(force_cpu=args.cpu)
+    backend = "numpy" if args.numpy or args.int8 or args.draft else "tensorflow"
+    generator = GPT2Generator(
+        force_cpu=args.cpu, backend=backend, quantize=args.int8, draft_model=args.draft
+    )
     story_manager = UnconstrainedStoryManager(generator)
+    opening_pool = None
+    if args.opening_pool > 0:
+        with open(YAML_FILE, "r") as stream:
+            story_data = yaml.safe_load(stream)
+        opening_pool = OpeningPool(
+            generator, story_data, get_curated_exposition, size=args.opening_pool
+        )
     print("\n")
 
     with open("opening.txt", "r", encoding="utf-8") as file:
@@ -198,20 +237,31 @@ def play_aidungeon_2(args):
                     setting_description,
                 ) = select_game()
 
+                opening = None
                 if setting_key == "custom":
                     context, prompt = get_custom_prompt()
 
                 else:
-                    context, prompt = get_curated_exposition(
-                        setting_key, character_key, name, character, setting_description
-                    )
+                    if opening_pool is not None:
+                        opening = opening_pool.take(setting_key, character_key, name)
+                    if opening is not None:
+                        context, prompt, block = opening
+                    else:
+                        context, prompt = get_curated_exposition(
+                            setting_key, character_key, name, character, setting_description
+                        )
 
                 console_print(instructions())
                 print("\nGenerating story...")
 
-                result = story_manager.start_new_story(
-                    prompt, context=context, upload_story=upload_story
-                )
+                if opening is not None:
+                    result = story_manager.start_story_with_block(
+                        prompt, block, context=context, upload_story=upload_story
+                    )
+                else:
+                    result = story_manager.start_new_story(
+                        prompt, context=context, upload_story=upload_story
+                    )
                 print("\n")
                 console_print(result)
 
@@ -320,8 +370,7 @@ def play_aidungeon_2(args):
             else:
                 if action == "":
                     action = ""
-                    result = story_manager.act(action)
-                    console_print(result)
+                    console_stream(story_manager.act_stream(action))
 
                 elif action[0] == '"':
                     action = "You say " + action
@@ -340,25 +389,31 @@ def play_aidungeon_2(args):
 
                     action = "\n> " + action + "\n"
 
-                result = "\n" + story_manager.act(action)
-                if len(story_manager.story.results) >= 2:
-                    similarity = get_similarity(
-                        story_manager.story.results[-1], story_manager.story.results[-2]
-                    )
-                    if similarity > 0.9:
-                        story_manager.story.actions = story_manager.story.actions[:-1]
-                        story_manager.story.results = story_manager.story.results[:-1]
-                        console_print(
-                            "Woops that action caused the model to start looping. Try a different action to prevent that."
+                print()
+                with timing.turn("turn"):
+                    result = "\n" + console_stream(story_manager.act_stream(action))
+                    looping = len(story_manager.story.results) >= 2 and (
+                        get_similarity(
+                            story_manager.story.results[-1],
+                            story_manager.story.results[-2],
                         )
-                        continue
+                        > 0.9
+                    )
+                if looping:
+                    story_manager.story.actions = story_manager.story.actions[:-1]
+                    story_manager.story.results = story_manager.story.results[:-1]
+                    # The result was already shown as it streamed in
+                    console_print(
+                        "Woops that action caused the model to start looping, so the text above was "
+                        "discarded and is not part of your story. Try a different action to prevent that."
+                    )
+                    continue
 
                 if player_won(result):
-                    console_print(result + "\n CONGRATS YOU WIN")
+                    console_print(" CONGRATS YOU WIN")
                     story_manager.story.get_rating()
                     break
                 elif player_died(result):
-                    console_print(result)
                     console_print("YOU DIED. GAME OVER")
                     console_print("\nOptions:")
                     console_print("0) Start a new game")
@@ -374,10 +429,12 @@ def play_aidungeon_2(args):
                         console_print("Sorry about that...where were we?")
                         console_print(result)
 
-                else:
-                    console_print(result)
-
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    if args.timing_log is not None:
+        handler = logging.FileHandler(args.timing_log)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        timing.logger.addHandler(handler)
+        timing.logger.setLevel(logging.INFO)
     play_aidungeon_2(args)
@@ -0,0 +1,125 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from story import grammars
+
+# Stands for the player's name in stored openings, as in the grammars
+NAME_TOKEN = "<NAME>"
+# Used when the character_name grammar gives no usable name
+PLACEHOLDER_NAME = "Vijeh"
+
+
+class OpeningPool:
+    """Openings generated ahead of time for every setting and character.
+
+    A daemon thread keeps up to size openings (context, prompt and first block)
+    for each setting/character pair of story_data, filling the emptiest pair
+    first. It only generates once the generator has been idle for idle_seconds,
+    and does so a stream chunk at a time, stopping between chunks whenever a
+    player uses the generator, so a player waits at most one chunk for it.
+    exposition(setting_key, character_key, name, character, setting_description)
+    returns the context and prompt, like play.py's get_curated_exposition.
+
+    Openings are generated with a placeholder name and stored with NAME_TOKEN in
+    its place, which take swaps for the player's name.
+    """
+
+    def __init__(self, generator, story_data, exposition, size=2, idle_seconds=2.0):
+        self.generator = generator
+        self.story_data = story_data
+        self.exposition = exposition
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.openings = {
+            (setting_key, character_key): deque()
+            for setting_key, setting in story_data["settings"].items()
+            for character_key in setting["characters"]
+        }
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def take(self, setting_key, character_key, name):
+        """A ready (context, prompt, block) for the pair, or None if there is none."""
+        with self.lock:
+            openings = self.openings.get((setting_key, character_key))
+            if not openings:
+                return None
+            opening = openings.popleft()
+        return tuple(text.replace(NAME_TOKEN, name) for text in opening)
+
+    def emptiest(self):
+        """The pair with the fewest openings, or None if all of them are full."""
+        with self.lock:
+            key = min(self.openings, key=lambda key: len(self.openings[key]))
+            if len(self.openings[key]) >= self.size:
+                return None
+            return key
+
+    def placeholder_name(self, setting_key, text, tries=10):
+        """A name for the setting that can't be mistaken for another word of the
+        opening: it isn't in text and isn't an ordinary word like "True"."""
+        for _ in range(tries):
+            try:
+                name = grammars.direct(setting_key, "character_name")
+            except:
+                break
+            pattern = re.compile(r"\b" + re.escape(name) + r"\b", re.IGNORECASE)
+            common_word = len(self.generator.encode(" " + name.lower())) == 1
+            if not common_word and pattern.search(text) is None:
+                return name
+        return PLACEHOLDER_NAME
+
+    def generate(self, setting_key, character_key):
+        setting = self.story_data["settings"][setting_key]
+        context, prompt = self.exposition(
+            setting_key,
+            character_key,
+            NAME_TOKEN,
+            setting["characters"][character_key],
+            setting["description"],
+        )
+        # The setting may name places the opening doesn't, like "Larion"
+        name = self.placeholder_name(
+            setting_key, context + prompt + setting["description"]
+        )
+        # Without taking the place of a player's story in the past cache
+        pieces = []
+        for piece in self.generator.generate_stream(
+            (context + prompt).replace(NAME_TOKEN, name), {"cache_past": False}
+        ):
+            pieces.append(piece)
+            self.wait_for_idle()
+        block = "".join(pieces)
+        # Whatever the block calls the character is the player's name
+        block = re.sub(r"\b" + re.escape(name) + r"\b", NAME_TOKEN, block)
+        return context, prompt, block
+
+    def idle(self):
+        """Whether nobody is waiting for the generator, and it was last used by this
+        thread or not for idle_seconds."""
+        if self.generator.waiting > 0:
+            return False
+        if self.generator.last_user == threading.get_ident():
+            return True
+        return time.time() - self.generator.last_used >= self.idle_seconds
+
+    def wait_for_idle(self):
+        while not self.idle():
+            # Spread out so a busy generator isn't polled in lock step
+            time.sleep(self.idle_seconds * random.uniform(0.5, 1))
+
+    def run(self):
+        while True:
+            key = self.emptiest()
+            if key is None:
+                time.sleep(self.idle_seconds * random.uniform(0.5, 1))
+                continue
+            self.wait_for_idle()
+            opening = self.generate(*key)
+            with self.lock:
+                self.openings[key].append(opening)
@@ -4,6 +4,8 @@ import subprocess
 import uuid
 from subprocess import Popen
 
+from other.cacher import Cacher
+from story import timing
 from story.utils import *
 
 
@@ -33,6 +35,9 @@ class Story:
         self.game_state = game_state
         self.memory = 20
 
+        # Token ids of the blocks in latest_result, so each is only encoded once
+        self.block_tokens = {}
+
     def __del__(self):
         if self.upload_story:
             self.save_to_storage()
@@ -65,21 +70,58 @@ class Story:
         self.actions.append(action)
         self.results.append(story_block)
 
-    def latest_result(self):
+    def latest_blocks(self):
 
         mem_ind = self.memory
         if len(self.results) < 2:
-            latest_result = self.story_start
+            blocks = [self.story_start]
         else:
-            latest_result = self.context
+            blocks = [self.context]
         while mem_ind > 0:
 
             if len(self.results) >= mem_ind:
-                latest_result += self.actions[-mem_ind] + self.results[-mem_ind]
+                blocks += [self.actions[-mem_ind], self.results[-mem_ind]]
 
             mem_ind -= 1
 
-        return latest_result
+        return blocks
+
+    def latest_result(self):
+        return "".join(self.latest_blocks())
+
+    def latest_result_tokens(self, encode, max_tokens=None):
+        """latest_result as token ids, only encoding blocks that weren't used before.
+
+        With max_tokens, the start (or context) is always kept and the newest
+        action/result pairs are added for as long as they fit.
+        """
+        block_tokens = {}
+
+        def tokens_of(block):
+            if block not in block_tokens:
+                if block in self.block_tokens:
+                    block_tokens[block] = self.block_tokens[block]
+                else:
+                    block_tokens[block] = encode(block)
+            return block_tokens[block]
+
+        start, *blocks = self.latest_blocks()
+        budget = float("inf") if max_tokens is None else max_tokens
+        budget -= len(tokens_of(start))
+        pairs = []
+        for i in range(len(blocks) - 2, -1, -2):
+            pair = tokens_of(blocks[i]) + tokens_of(blocks[i + 1])
+            if len(pair) > budget:
+                break
+            budget -= len(pair)
+            pairs.append(pair)
+
+        tokens = list(tokens_of(start))
+        for pair in reversed(pairs):
+            tokens.extend(pair)
+        # Blocks that are out of memory are forgotten
+        self.block_tokens = block_tokens
+        return tokens
 
     def __str__(self):
         story_list = [self.story_start]
@@ -170,6 +212,18 @@ class StoryManager:
         self, story_prompt, context="", game_state=None, upload_story=False
     ):
         block = self.generator.generate(context + story_prompt)
+        return self.start_story_with_block(
+            story_prompt,
+            block,
+            context=context,
+            game_state=game_state,
+            upload_story=upload_story,
+        )
+
+    def start_story_with_block(
+        self, story_prompt, block, context="", game_state=None, upload_story=False
+    ):
+        """start_new_story with its first block already generated."""
         block = cut_trailing_sentence(block)
         self.story = Story(
             context + story_prompt + block,
@@ -213,16 +267,44 @@ class StoryManager:
     def story_context(self):
         return self.story.latest_result()
 
+    def story_prompt(self, action):
+        """story_context() + action, as token ids if the generator has an encoder.
+
+        Then the oldest action/result pairs that don't fit the generator's
+        prompt_budget are left out.
+        """
+        return self.story_prompts([action])[0]
+
+    def story_prompts(self, actions):
+        """story_prompt of each of actions, all starting with the same story context."""
+        if getattr(self.generator, "enc", None) is None:
+            return [self.story_context() + action for action in actions]
+        encode = self.generator.encode
+        action_tokens = [encode(action) for action in actions]
+        max_tokens = self.generator.prompt_budget() - max(map(len, action_tokens))
+        context_tokens = self.story.latest_result_tokens(encode, max_tokens)
+        return [context_tokens + tokens for tokens in action_tokens]
+
 
 class UnconstrainedStoryManager(StoryManager):
+    @timing.timed("act", kind=timing.turn)
     def act(self, action_choice):
 
         result = self.generate_result(action_choice)
         self.story.add_to_story(action_choice, result)
         return result
 
+    def act_stream(self, action_choice):
+        """Like act, but yields the result in pieces as it is generated."""
+        with timing.turn("act"):
+            result = ""
+            for chunk in self.generator.generate_stream(self.story_prompt(action_choice)):
+                result += chunk
+                yield chunk
+            self.story.add_to_story(action_choice, result)
+
     def generate_result(self, action):
-        block = self.generator.generate(self.story_context() + action)
+        block = self.generator.generate(self.story_prompt(action))
         return block
 
 
@@ -251,6 +333,8 @@ class ConstrainedStoryManager(StoryManager):
 
     def start_new_story_generate(self, story_prompt, game_state=None):
         super().start_new_story(story_prompt, game_state=game_state)
+        # The first action results are cached under the story's seed
+        self.story.seed = self.seed
         self.story.possible_action_results = self.get_action_results()
         return self.story.story_start
 
@@ -265,8 +349,9 @@ class ConstrainedStoryManager(StoryManager):
             story_start = self.start_new_story_generate(
                 story_prompt, game_state=game_state
             )
-            self.story.seed = self.seed
-            self.cacher.cache_file(self.seed, [], story_start, "story")
+            # Only the generated part, as story_prompt is put back in front of it
+            response = story_start[len(story_prompt) :]
+            self.cacher.cache_file(self.seed, [], response, "story")
 
         return story_start
 
@@ -282,6 +367,7 @@ class ConstrainedStoryManager(StoryManager):
             action_result[0] for action_result in self.story.possible_action_results
         ]
 
+    @timing.timed("act", kind=timing.turn)
     def act(self, action_choice_str):
 
         try:
@@ -307,9 +393,12 @@ class ConstrainedStoryManager(StoryManager):
             return self.get_action_results_generate()
 
     def get_action_results_generate(self):
+        # One batch, so the story context the phrases share is only run once
+        prompts = self.story_prompts([" " + phrase for phrase in self.action_phrases])
+        results = self.generator.generate_batch(prompts)
         action_results = [
-            self.generate_action_result(self.story_context(), phrase)
-            for phrase in self.action_phrases
+            split_first_sentence(phrase + " " + result)
+            for phrase, result in zip(self.action_phrases, results)
         ]
         return action_results
 
@@ -329,11 +418,3 @@ class ConstrainedStoryManager(StoryManager):
                 self.story.seed, self.story.choices, response, "choices"
             )
             return action_results
-
-    def generate_action_result(self, prompt, phrase, options=None):
-
-        action_result = (
-            phrase + " " + self.generator.generate(prompt + " " + phrase, options)
-        )
-        action, result = split_first_sentence(action_result)
-        return action, result
@@ -4,6 +4,7 @@ from difflib import SequenceMatcher
 
 import yaml
 from profanityfilter import ProfanityFilter
+from story import timing
 
 YAML_FILE = "story/story_data.yaml"
 
@@ -29,10 +30,39 @@ def console_print(text, width=75):
     print(text)
 
 
+def console_stream(chunks, width=75):
+    """console_print for text that arrives in pieces. Returns the whole text."""
+    text = ""
+    last_newline = 0
+    for chunk in chunks:
+        wrapped = ""
+        for char in chunk:
+            if char == "\n":
+                last_newline = 0
+            elif last_newline > width and char == " ":
+                wrapped += "\n"
+                last_newline = 1
+            else:
+                last_newline += 1
+            wrapped += char
+        print(wrapped, end="", flush=True)
+        text += chunk
+    print()
+    return text
+
+
+@timing.timed()
 def get_similarity(a, b):
     return SequenceMatcher(None, a, b).ratio()
 
 
+def get_action_verbs(key):
+    """The action phrases offered by constrained mode, from action_verbs in story_data.yaml."""
+    with open(YAML_FILE, "r") as stream:
+        data = yaml.safe_load(stream)
+    return data["action_verbs"][key]
+
+
 def get_num_options(num):
 
     while True:
@@ -78,6 +108,7 @@ def player_won(text):
     return any(re.search(regexp, lower_text) for regexp in won_phrases)
 
 
+@timing.timed()
 def remove_profanity(text):
     return pf.censor(text)
 
@@ -100,7 +131,7 @@ def split_first_sentence(text):
     elif first_period > 0:
         split_point = first_period + 1
     else:
-        split_point = text[0:20]
+        split_point = 20
 
     return text[0:split_point], text[split_point:]
 
@@ -118,6 +149,7 @@ def cut_trailing_action(text):
     return text
 
 
+@timing.timed()
 def cut_trailing_sentence(text):
     text = standardize_punctuation(text)
     last_punc = max(text.rfind("."), text.rfind("!"), text.rfind("?"))
@@ -270,6 +302,7 @@ def standardize_punctuation(text):
     return text
 
 
+@timing.timed()
 def first_to_second_person(text):
     text = " " + text
     text = standardize_punctuation(text)
@@ -281,6 +314,7 @@ def first_to_second_person(text):
     return capitalize_first_letters(text[1:])
 
 
+@timing.timed()
 def second_to_first_person(text):
     text = " " + text
     text = standardize_punctuation(text)